@@ -1,154 +1,1945 @@
-import math, os, io, base64, json, threading, webbrowser, time, random
+import math, os, io, sys, base64, json, threading, webbrowser, time, random, zlib, zipfile, hashlib, queue, uuid, multiprocessing, argparse, tempfile, cProfile, itertools, functools
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
 import numpy as np
-from PIL import Image
-from scipy import ndimage
-from skimage import measure
-from flask import Flask, request, jsonify, send_file, render_template_string
-
-app = Flask(__name__)
+from PIL import Image, ImageDraw
+# scipy, scikit-image and flask are imported where they are used, so the CLI starts
+# fast and a conversion only loads what its infill mode needs.
 
 # ─────────────────────────────────────────────
 # CORE ENGINE
 # ─────────────────────────────────────────────
 
+class PathSet:
+    # Ragged polyline store: all points in one (N, 2) coordinate buffer, path i at
+    # xy[offsets[i]:offsets[i+1]]. Indexing gives views, reversed(i) a backwards view
+    # of the same memory. 16 bytes a point instead of 100+ for lists of tuples.
+    def __init__(self, xy, offsets):
+        self.xy, self.offsets = xy, offsets
+
+    @classmethod
+    def from_arrays(cls, arrays, dtype=np.float64):
+        offsets = np.zeros(len(arrays) + 1, np.int64)
+        np.cumsum([len(a) for a in arrays], out=offsets[1:])
+        xy = np.concatenate(arrays).astype(dtype, copy=False) if arrays else np.empty((0, 2), dtype)
+        return cls(xy, offsets)
+
+    @classmethod
+    def from_entry(cls, entry):
+        return cls(entry['xy'], entry['offsets'])
+
+    def entry(self):
+        return {'xy': self.xy, 'offsets': self.offsets}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.xy[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        o = self.offsets.tolist()
+        return (self.xy[a:b] for a, b in zip(o[:-1], o[1:]))
+
+    def reversed(self, i):
+        return self[i][::-1]
+
+    @property
+    def n_points(self):
+        return int(self.offsets[-1])
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def path_lengths(self):
+        # drawn length of each path, in the units of xy
+        seg = np.zeros(len(self.xy))
+        seg[1:] = np.hypot(*np.diff(self.xy, axis=0).T)
+        seg[self.offsets[1:-1]] = 0  # hops from one path to the next
+        cum = np.cumsum(seg)
+        return cum[np.maximum(self.offsets[1:] - 1, 0)] - cum[self.offsets[:-1]] if len(self) else seg
+
+    def endpoints(self):
+        # (2n, 2): start of path i at 2i, end at 2i+1
+        ends = np.empty((2 * len(self), 2), self.xy.dtype)
+        ends[0::2], ends[1::2] = self.xy[self.offsets[:-1]], self.xy[self.offsets[1:] - 1]
+        return ends
+
+    def take(self, order, flip=None):
+        # Reorders paths, reversing those with flip set, in one gather over the buffer.
+        lens = self.lengths[order]
+        offsets = np.zeros(len(lens) + 1, np.int64)
+        np.cumsum(lens, out=offsets[1:])
+        idx = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lens)
+        if flip is not None:
+            idx = np.where(np.repeat(flip, lens), np.repeat(lens - 1, lens) - idx, idx)
+        return PathSet(self.xy[np.repeat(self.offsets[:-1][order], lens) + idx], offsets)
+
+    def select(self, keep):
+        # Keeps the points where the bool mask `keep` is set.
+        kept = np.zeros(len(keep) + 1, np.int64)
+        np.cumsum(keep, out=kept[1:])
+        return PathSet(self.xy[keep], kept[self.offsets])
+
 class PathOptimizer:
+    # Greedy nearest neighbour over both endpoints of every path, so each pick also
+    # fixes the drawing direction. Endpoints sit in a KD-tree; taken paths are
+    # skipped lazily and the tree is rebuilt once half of its entries are stale.
+    @staticmethod
+    def optimize(paths, start_pos, refine_time=0.0, progress=None, regions=None):
+        # regions: optional id per path; each region is then finished before the next
+        # starts, and 2-opt (which would interleave them) is skipped.
+        if len(paths) == 0: return paths
+        ends = paths.endpoints().astype(np.float64, copy=False)
+        if regions is not None:
+            order, flip = PathOptimizer._by_region(ends, regions, start_pos, progress)
+            return paths.take(order, flip)
+        order, flip = PathOptimizer._greedy(ends, start_pos, progress)
+        if refine_time > 0:
+            PathOptimizer._two_opt(ends, order, flip, start_pos, refine_time)
+        return paths.take(order, flip)
+
+    @staticmethod
+    def _greedy(ends, start_pos, progress=None):
+        from scipy.spatial import cKDTree
+        n = len(ends) // 2
+        used = np.zeros(n, bool)
+        order, flip = np.empty(n, np.int64), np.zeros(n, bool)
+        live = np.arange(2*n)
+        tree = cKDTree(ends)
+        curr, k, stale = start_pos, 8, 0
+        for step in range(n):
+            if progress and step % 4096 == 0: progress(step / n)
+            while True:
+                kk = min(k, len(live))
+                _, idx = tree.query(curr, k=kk)
+                hit = next((live[j] for j in np.atleast_1d(idx).tolist() if not used[live[j] >> 1]), None)
+                if hit is not None: break
+                k *= 2
+            p = hit >> 1
+            used[p] = True
+            order[step], flip[step] = p, hit & 1
+            curr = ends[hit ^ 1]
+            stale += 2
+            k = max(8, k // 2)
+            if stale * 2 > len(live) and step < n - 1:
+                live = np.flatnonzero(~used[np.arange(2*n) >> 1])
+                tree, stale = cKDTree(ends[live]), 0
+        return order, flip
+
+    @staticmethod
+    def _by_region(ends, regions, start_pos, progress=None):
+        # The nearest end of any unfinished region picks the next region, which is
+        # then ordered with _greedy from there. Same lazy pruning as _greedy.
+        from scipy.spatial import cKDTree
+        n = len(ends) // 2
+        sizes = np.bincount(regions)
+        members = np.split(np.argsort(regions, kind='stable'), np.cumsum(sizes)[:-1])
+        done = sizes == 0
+        order, flip = [], []
+        live = np.arange(2*n)
+        tree = cKDTree(ends)
+        curr, k, stale, drawn = start_pos, 8, 0, 0
+        while not done.all():
+            if progress: progress(drawn / n)
+            while True:
+                kk = min(k, len(live))
+                _, idx = tree.query(curr, k=kk)
+                hit = next((live[j] for j in np.atleast_1d(idx).tolist() if not done[regions[live[j] >> 1]]), None)
+                if hit is not None: break
+                k *= 2
+            g = regions[hit >> 1]
+            done[g], k = True, 8
+            sub = members[g]
+            o, f = PathOptimizer._greedy(ends.reshape(-1, 2, 2)[sub].reshape(-1, 2), curr)
+            order.append(sub[o]); flip.append(f)
+            curr = ends[2*sub[o[-1]] + 1 - f[-1]]
+            drawn += len(sub)
+            stale += 2 * len(sub)
+            if stale * 2 > len(live) and drawn < n:
+                live = np.flatnonzero(~done[regions[np.arange(2*n) >> 1]])
+                tree, stale = cKDTree(ends[live]), 0
+        return np.concatenate(order), np.concatenate(flip)
+
+    @staticmethod
+    def _two_opt(ends, order, flip, start_pos, time_budget, k=8):
+        # Reversing the block [a..b] turns (exit a-1 -> entry a, exit b -> entry b+1)
+        # into (exit a-1 -> exit b, entry a -> entry b+1). Candidates for b come from
+        # the endpoints nearest to exit a-1.
+        from scipy.spatial import cKDTree
+        n = len(order)
+        if n < 3: return
+        deadline = time.monotonic() + time_budget
+        tree = cKDTree(ends)
+        pos = np.empty(n, np.int64)
+        pos[order] = np.arange(n)
+        d = lambda a, b: math.hypot(a[0]-b[0], a[1]-b[1])
+        entry = lambda i: ends[2*order[i] + flip[i]]
+        exit_ = lambda i: ends[2*order[i] + 1 - flip[i]]
+        improved = True
+        while improved and time.monotonic() < deadline:
+            improved = False
+            for a in range(n):
+                prev = exit_(a-1) if a else start_pos
+                _, idx = tree.query(prev, k=min(k, len(ends)))
+                for e in np.atleast_1d(idx).tolist():
+                    b = pos[e >> 1]
+                    if b < a or (e & 1) == flip[b]: continue
+                    before = d(prev, entry(a)) + (d(exit_(b), entry(b+1)) if b < n-1 else 0.0)
+                    after  = d(prev, exit_(b)) + (d(entry(a), entry(b+1)) if b < n-1 else 0.0)
+                    if after < before - 1e-9:
+                        order[a:b+1] = order[a:b+1][::-1].copy()
+                        flip[a:b+1] = ~flip[a:b+1][::-1]
+                        pos[order[a:b+1]] = np.arange(a, b+1)
+                        improved = True
+                        break
+                if time.monotonic() >= deadline: return
+
+class DipScheduler:
+    # Picks whole strokes for dip loads: the nearest stroke end, from any position,
+    # whose stroke is no longer than a limit. Same lazily pruned KD-tree over both
+    # endpoints as PathOptimizer._greedy; once the nearest BRUTE ends all fail the
+    # limit, the remaining ones are searched in bulk.
+    BRUTE = 256
+
+    def __init__(self, paths, lengths=None):
+        from scipy.spatial import cKDTree
+        n = len(paths)
+        self.ends = paths.endpoints().astype(np.float64, copy=False)
+        self.length = paths.path_lengths() if lengths is None else lengths
+        self.used = np.zeros(n, bool)
+        self.left = n
+        self.live = np.arange(2*n)
+        self.tree, self.stale, self.k = cKDTree(self.ends), 0, 8
+
+    def pick(self, pos, limit=np.inf):
+        # (path, flip) of the nearest fitting stroke, marked used, or None if none fits
+        if not self.left: return None
+        k = self.k
+        while True:
+            kk = min(k, len(self.live))
+            _, idx = self.tree.query(pos, k=kk)
+            cand = self.live[np.atleast_1d(idx)]
+            p = cand >> 1
+            ok = ~self.used[p] & (self.length[p] <= limit)
+            if ok.any():
+                hit = int(cand[ok.argmax()])
+                self.k = max(8, k // 2)
+                break
+            if kk == len(self.live): return None
+            if k >= self.BRUTE:
+                p = self.live >> 1
+                ok = np.flatnonzero(~self.used[p] & (self.length[p] <= limit))
+                if not len(ok): return None
+                d = self.ends[self.live[ok]] - pos
+                hit = int(self.live[ok[np.argmin(np.einsum('ij,ij->i', d, d))]])
+                break
+            k *= 2
+        p = hit >> 1
+        self.used[p] = True
+        self.left -= 1
+        self.stale += 2
+        if self.stale * 2 > len(self.live) and self.left:
+            from scipy.spatial import cKDTree
+            self.live = np.flatnonzero(~self.used[np.arange(len(self.ends)) >> 1])
+            self.tree, self.stale = cKDTree(self.ends[self.live]), 0
+        return p, hit & 1
+
+class BitMask:
+    # Boolean raster packed 8 px per byte along rows, in memory or in an unlinked
+    # memory-mapped temp file. Indexing with row/column index arrays reads bits
+    # straight from the packed rows, so ScanlineEngine samples it like a bool array.
+    def __init__(self, bits, width):
+        self.bits, self.width = bits, int(width)
+        self.shape = (len(bits), self.width)
+
+    @classmethod
+    def empty(cls, h, w, memmap=False):
+        size = (h, (w + 7) // 8)
+        if not memmap:
+            return cls(np.zeros(size, np.uint8), w)
+        fd, path = tempfile.mkstemp(suffix='.bits')
+        os.close(fd)
+        bits = np.memmap(path, np.uint8, 'w+', shape=size)
+        os.remove(path)
+        return cls(bits, w)
+
+    @classmethod
+    def pack(cls, arr):
+        return cls(np.packbits(arr, axis=1), arr.shape[1])
+
+    @classmethod
+    def from_entry(cls, entry):
+        return cls(entry['bits'], entry['width'])
+
+    def entry(self):
+        return {'bits': np.asarray(self.bits), 'width': np.int64(self.width)}
+
+    def __getitem__(self, idx):
+        r, c = idx
+        return ((self.bits[r, c >> 3] >> (7 - (c & 7))) & 1).astype(bool)
+
+    def rows(self, rows, c0=0, c1=None):
+        c1 = self.width if c1 is None else c1
+        b0 = c0 >> 3
+        out = np.unpackbits(self.bits[rows, b0:(c1 + 7) >> 3], axis=1)
+        return out[:, c0 - 8*b0:c1 - 8*b0].view(bool)
+
+    def put(self, r0, c0, arr):
+        # c0 must fall on a byte boundary, and the block must end on one or at the right edge
+        packed = np.packbits(arr, axis=1)
+        self.bits[r0:r0 + len(arr), c0 >> 3:(c0 >> 3) + packed.shape[1]] = packed
+
+    def unpack(self):
+        return self.rows(slice(None))
+
+    def resample(self, rows, cols, memmap=False, band=1024):
+        # Nearest-neighbour gather, a band of output rows at a time.
+        out = BitMask.empty(len(rows), len(cols), memmap)
+        for b in range(0, len(rows), band):
+            out.put(b, 0, self.rows(rows[b:b+band])[:, cols])
+        return out
+
+def nearest_index(n, m):
+    # Source index of each of m samples when PIL NEAREST-resizes n pixels to m.
+    idx = Image.fromarray(np.arange(n, dtype=np.int32)[None, :]).resize((m, 1), Image.Resampling.NEAREST)
+    return np.asarray(idx)[0].astype(np.int64)
+
+class ScanlineEngine:
+    # Rotates the whole sample grid in bulk, a band of scanlines at a time, and
+    # cuts each scanline into runs of painted samples. Sample order and the int()
+    # truncation match the original per-pixel loop exactly.
+    BATCH = 1 << 21
+
+    @staticmethod
+    def frame(shape, angle, step_px):
+        # Unrotated sample positions: scanline y_all[r], column c sits at
+        # (bx[c] - y_all[r]*sin, by[c] + y_all[r]*cos) before truncation.
+        angle_rad = math.radians(angle)
+        cos_a, sin_a = math.cos(angle_rad), math.sin(angle_rad)
+        h, w = shape
+        cx, cy = w / 2.0, h / 2.0
+        diag = int(math.hypot(w, h)) + 10
+        x_rot = np.arange(-diag, diag, dtype=np.float64)
+        bx, by = cx + x_rot * cos_a, cy + x_rot * sin_a
+        y_all = np.arange(-diag, diag, max(1, step_px), dtype=np.float64)
+        return cos_a, sin_a, bx, by, y_all
+
     @staticmethod
-    def optimize(paths, start_pos):
-        num_paths = len(paths)
-        if num_paths == 0: return []
-        if num_paths > 5000:
-            return sorted(paths, key=lambda p: (p[0][0] // 20, p[0][1] if (p[0][0] // 20) % 2 == 0 else -p[0][1]))
-        optimized = []
-        remaining = list(paths)
-        curr = np.array(start_pos)
-        while remaining:
-            idx = min(range(len(remaining)), key=lambda i: math.hypot(remaining[i][0][0]-curr[0], remaining[i][0][1]-curr[1]))
-            path = remaining.pop(idx)
-            optimized.append(path)
-            curr = np.array(path[-1])
-        return optimized
+    def spans(arr, angle, step_px, progress=None, lines=None):
+        # (scanline, c0, c1, xs, ys) per run, scanline by scanline; lines: a range of
+        # scanline indices to cover instead of all of them
+        h, w = arr.shape
+        cos_a, sin_a, bx, by, y_all = ScanlineEngine.frame(arr.shape, angle, step_px)
+        first, y_all = (lines.start, y_all[lines.start:lines.stop]) if lines else (0, y_all)
+        m = len(bx)
+        rows = max(1, ScanlineEngine.BATCH // m)
+        for b in range(0, len(y_all), rows):
+            y_rot = y_all[b:b+rows, None]
+            ox = (bx - y_rot * sin_a).astype(np.int64)
+            oy = (by + y_rot * cos_a).astype(np.int64)
+            valid = (ox >= 0) & (ox < w) & (oy >= 0) & (oy < h)
+            valid &= arr[np.clip(oy, 0, h-1), np.clip(ox, 0, w-1)]
+            # a trailing False column keeps runs from wrapping onto the next scanline
+            padded = np.zeros((len(y_rot), m + 1), np.int8)
+            padded[:, :m] = valid
+            edges = np.diff(padded.ravel(), prepend=0)
+            starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+            for s, e in zip(starts.tolist(), ends.tolist()):
+                if e - s > 1:
+                    r, c0 = divmod(s, m + 1)
+                    c1 = c0 + (e - s)
+                    yield first + b + r, c0, c1, ox[r, c0:c1], oy[r, c0:c1]
+            if progress: progress(min(1.0, (b + rows) / len(y_all)))
+
+    @staticmethod
+    def zigzag(arr, angle, step_px, progress=None, spans=None):
+        # Boustrophedon strokes. A stroke ending on one scanline carries on into a run
+        # of the next that overlaps its last run, entering at the near end, as long
+        # as the straight link between the two stays on painted samples; shortest
+        # links are taken first. Runs overlapping on neighbouring scanlines also
+        # share a region id (union-find), returned per stroke. spans: the runs, if
+        # already traced.
+        frame = ScanlineEngine.frame(arr.shape, angle, step_px)
+        parent = []
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        strokes, roots = [], []
+        open_, prev = [], None  # open_: [pieces, first run, c0, c1, went right] per stroke
+        spans = ScanlineEngine.spans(arr, angle, step_px, progress) if spans is None else spans
+        for row, group in itertools.groupby(spans, key=lambda t: t[0]):
+            runs = []
+            for _, c0, c1, xs, ys in group:
+                parent.append(len(parent))
+                runs.append((len(parent) - 1, c0, c1, np.column_stack((xs, ys))))
+            if prev != row - 1:
+                strokes += [o[0] for o in open_]; roots += [o[1] for o in open_]
+                open_ = []
+            open_.sort(key=lambda o: o[2])
+            pairs, i = [], 0
+            for a, o in enumerate(open_):
+                while i < len(runs) and runs[i][2] <= o[2]: i += 1
+                for j in range(i, len(runs)):
+                    if runs[j][1] >= o[3]: break
+                    pairs.append((a, j))
+                    ra, rb = find(o[1]), find(runs[j][0])
+                    if ra != rb: parent[rb] = ra
+            taken = [False] * len(runs)
+            carried = [None] * len(open_)
+            if pairs:
+                a, j = np.array(pairs).T
+                right = np.array([open_[k][4] for k in a.tolist()])
+                c_out = np.where(right, [open_[k][3] - 1 for k in a.tolist()], [open_[k][2] for k in a.tolist()])
+                c_in = np.where(right, [runs[k][2] - 1 for k in j.tolist()], [runs[k][1] for k in j.tolist()])
+                ok = ScanlineEngine._linked(arr, frame, row - 1, c_out, row, c_in)
+                for k in np.flatnonzero(ok)[np.argsort(np.abs(c_out - c_in)[ok], kind='stable')].tolist():
+                    ak, jk = int(a[k]), int(j[k])
+                    if carried[ak] is not None or taken[jk]: continue
+                    o = open_[ak]
+                    xy = runs[jk][3]
+                    o[0].append(xy[::-1] if o[4] else xy)
+                    o[2], o[3], o[4] = runs[jk][1], runs[jk][2], not o[4]
+                    carried[ak], taken[jk] = o, True
+            for o, kept in zip(open_, carried):
+                if kept is None: strokes.append(o[0]); roots.append(o[1])
+            open_ = [o for o in carried if o is not None]
+            open_ += [[[xy], r, c0, c1, True] for (r, c0, c1, xy), t in zip(runs, taken) if not t]
+            prev = row
+        strokes += [o[0] for o in open_]; roots += [o[1] for o in open_]
+        regions = np.unique([find(r) for r in roots], return_inverse=True)[1] if roots else np.zeros(0, np.int64)
+        return [np.concatenate(p) for p in strokes], regions.astype(np.int64)
+
+    @staticmethod
+    def _linked(arr, frame, r0, c0, r1, c1):
+        # Whether each straight link between the samples (r0, c0) and (r1, c1), as
+        # drawn between their truncated pixels, only crosses painted pixels.
+        cos_a, sin_a, bx, by, y_all = frame
+        h, w = arr.shape
+        x0 = (bx[c0] - y_all[r0] * sin_a).astype(np.int64); y0 = (by[c0] + y_all[r0] * cos_a).astype(np.int64)
+        x1 = (bx[c1] - y_all[r1] * sin_a).astype(np.int64); y1 = (by[c1] + y_all[r1] * cos_a).astype(np.int64)
+        n = 2 * (np.abs(x1 - x0) + np.abs(y1 - y0)) + 1
+        start = np.zeros(len(n), np.int64)
+        np.cumsum(n[:-1], out=start[1:])
+        link = np.repeat(np.arange(len(n)), n)
+        t = (np.arange(n.sum()) - start[link]) / np.maximum(n - 1, 1)[link]
+        ox = np.floor(x0[link] + (x1 - x0)[link] * t).astype(np.int64)
+        oy = np.floor(y0[link] + (y1 - y0)[link] * t).astype(np.int64)
+        ok = (ox >= 0) & (ox < w) & (oy >= 0) & (oy < h)
+        ok &= arr[np.clip(oy, 0, h-1), np.clip(ox, 0, w-1)]
+        return np.logical_and.reduceat(ok, start)
+
+class ConcentricEngine:
+    # A single distance transform replaces the iterated erosion: erosion level k is
+    # {dist > k*step}, and under the taxicab metric (binary_erosion's default cross)
+    # that is exactly the old mask. Each connected region is traced on its own,
+    # inside a bounding box that shrinks with the live area at every level.
+    MAX_LEVELS = 2000
+
+    @staticmethod
+    def distance(arr, metric='taxicab', pad=((1, 1), (1, 1))):
+        # pad: background rows/cols added per side; the canvas edge erodes like background
+        from scipy import ndimage
+        padded = np.pad(arr, pad)
+        if metric == 'euclidean':
+            dist = ndimage.distance_transform_edt(padded)
+        else:
+            dist = ndimage.distance_transform_cdt(padded, metric=metric)
+        (t, b), (l, r) = pad
+        return dist[t:dist.shape[0] - b, l:dist.shape[1] - r]
+
+    @staticmethod
+    def regions(arr, metric='taxicab'):
+        # (distance transform, 8-connected labels, bounding slice of each label)
+        from scipy import ndimage
+        dist = ConcentricEngine.distance(arr, metric)
+        labels, _ = ndimage.label(arr, structure=np.ones((3, 3)))
+        return dist, labels, ndimage.find_objects(labels)
+
+    @staticmethod
+    def contours(arr, step, metric='taxicab', progress=None):
+        # progress goes by bounding-box area and, within a region, by level, so a
+        # canvas that is one big region still reports (and can be cancelled) as it goes
+        dist, labels, objects = ConcentricEngine.regions(arr, metric)
+        area = [(sl[0].stop - sl[0].start) * (sl[1].stop - sl[1].start) for sl in objects]
+        total, done = max(1, sum(area)), 0
+        for lbl, sl in enumerate(objects, 1):
+            report = progress and (lambda frac, done=done, a=area[lbl - 1]: progress((done + a * frac) / total))
+            yield from ConcentricEngine.region_contours(dist, labels, lbl, sl, step, report)
+            done += area[lbl - 1]
+
+    @staticmethod
+    def region_contours(dist, labels, lbl, sl, step, progress=None):
+        # Every level of region lbl, traced inside its shrinking bounding box
+        from skimage import measure
+        h, w = dist.shape
+        sub = np.where(labels[sl] == lbl, dist[sl], 0)
+        r0, c0 = sl[0].start, sl[1].start
+        deepest = max(float(sub.max()) if sub.size else 0.0, 1.0)
+        for level in range(ConcentricEngine.MAX_LEVELS):
+            if progress: progress(min(1.0, level * step / deepest))
+            live = sub > level * step
+            rows, cols = np.flatnonzero(live.any(1)), np.flatnonzero(live.any(0))
+            if not len(rows): break
+            rs, cs = slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)
+            sub, r0, c0 = sub[rs, cs], r0 + rs.start, c0 + cs.start
+            # pad only away from the canvas edge, where the old full-array trace left contours open
+            pr = (int(r0 > 0), int(r0 + sub.shape[0] < h))
+            pc = (int(c0 > 0), int(c0 + sub.shape[1] < w))
+            for ct in measure.find_contours(np.pad(live[rs, cs], (pr, pc)).astype(np.float32), 0.5):
+                yield ct + (r0 - pr[0], c0 - pc[0])
+
+    @staticmethod
+    def tiled_contours(mask, step, metric='taxicab', tile=1024, memmap=False, progress=None):
+        # Same contours for a BitMask canvas in bounded memory. Levels go in passes
+        # `depth` deep: a tile's distance transform with a halo of depth is exact up to
+        # depth, and {dist > depth} seeds the next pass, as erosions compose exactly
+        # under taxicab and chessboard (euclidean only approximately). Each tile traces
+        # one extra row and column, so contours cut at a seam share their end points
+        # and are stitched back together.
+        from skimage import measure
+        h, w = mask.shape
+        tile = max(8, tile // 8 * 8)
+        depth = max(1, tile // 4 // step) * step
+        tiles = [(r0, c0) for r0 in range(0, h, tile) for c0 in range(0, w, tile)]
+        offset = 0
+        while offset < ConcentricEngine.MAX_LEVELS * step:
+            nxt = BitMask.empty(h, w, memmap)
+            pieces, live_next = {}, False
+            for n, (r0, c0) in enumerate(tiles):
+                if progress: progress(n / len(tiles))
+                r1, c1 = min(r0 + tile, h), min(c0 + tile, w)
+                wr0, wr1, wc0, wc1 = max(0, r0 - depth), min(h, r1 + depth), max(0, c0 - depth), min(w, c1 + depth)
+                win = mask.rows(slice(wr0, wr1), wc0, wc1)
+                if not win[r0-wr0:min(r1 + 1, h)-wr0, c0-wc0:min(c1 + 1, w)-wc0].any(): continue
+                pad = ((int(wr0 == 0), int(wr1 == h)), (int(wc0 == 0), int(wc1 == w)))
+                if not any(pad[0] + pad[1]) and win.all():
+                    # no background within reach: all deeper than this pass, nothing to trace
+                    nxt.put(r0, c0, np.ones((r1 - r0, c1 - c0), bool))
+                    live_next = True
+                    continue
+                dist = ConcentricEngine.distance(win, metric, pad)
+                deep = dist[r0-wr0:r1-wr0, c0-wc0:c1-wc0] > depth
+                if deep.any():
+                    nxt.put(r0, c0, deep)
+                    live_next = True
+                trace = dist[r0-wr0:min(r1 + 1, h)-wr0, c0-wc0:min(c1 + 1, w)-wc0]
+                # a 1 px tile on the last row or column has no cells of its own: the tile
+                # before it traced them with its extra row or column
+                if min(trace.shape) < 2: continue
+                for level in range(offset // step, min((offset + depth) // step, ConcentricEngine.MAX_LEVELS)):
+                    live = trace > level * step - offset
+                    if not live.any(): break
+                    for ct in measure.find_contours(live.astype(np.float32), 0.5):
+                        pieces.setdefault(level, []).append(ct + (r0, c0))
+            for level in sorted(pieces):
+                yield from ConcentricEngine._stitch(pieces[level])
+            if not live_next: break
+            mask, offset = nxt, offset + depth
+
+    @staticmethod
+    def _stitch(pieces):
+        # find_contours winds every contour the same way, so a piece cut at a seam
+        # ends exactly where its continuation in the neighbouring tile starts.
+        closed = [p for p in pieces if (p[0] == p[-1]).all()]
+        cut = [p for p in pieces if not (p[0] == p[-1]).all()]
+        starts = {tuple(p[0]): i for i, p in enumerate(cut)}
+        ends = {tuple(p[-1]) for p in cut}
+        used = [False] * len(cut)
+        # chains that stop at the canvas edge first, from their head; what is left are loops
+        heads = [i for i, p in enumerate(cut) if tuple(p[0]) not in ends]
+        for i in heads + list(range(len(cut))):
+            chain = []
+            while i is not None and not used[i]:
+                used[i] = True
+                chain.append(cut[i] if not chain else cut[i][1:])
+                i = starts.get(tuple(cut[i][-1]))
+            if chain: yield np.concatenate(chain)
+        yield from closed
+
+class SharedArray:
+    # A numpy array in multiprocessing.shared_memory. The owner copies an array in
+    # once; pool workers attach by spec (name, shape, dtype) instead of receiving a
+    # pickled copy, and drop their views before close(). The owner unlinks it.
+    def __init__(self, shm, shape, dtype):
+        self.shm, self.shape, self.dtype = shm, tuple(shape), np.dtype(dtype)
+
+    @classmethod
+    def copy_of(cls, arr):
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+        out = cls(shm, arr.shape, arr.dtype)
+        out.array()[...] = arr
+        return out
+
+    @classmethod
+    def attach(cls, spec):
+        from multiprocessing import shared_memory
+        name, shape, dtype = spec
+        return cls(shared_memory.SharedMemory(name=name), shape, dtype)
+
+    @property
+    def spec(self):
+        return self.shm.name, self.shape, self.dtype.str
+
+    def array(self):
+        return np.ndarray(self.shape, self.dtype, self.shm.buf)
+
+    def close(self, unlink=False):
+        self.shm.close()
+        if unlink: self.shm.unlink()
+
+class ParallelInfill:
+    # Infill of a single layer over a process pool. The packed mask (scanlines), or
+    # the distance transform and labels (concentric), go into shared memory once;
+    # workers get bands of scanlines or chunks of connected regions and send back
+    # paths. Results are merged in input order, so paths match serial infill exactly.
+    CHUNKS = 4  # tasks per worker, so uneven bands and regions even out
+    POLL_S = 0.2  # how often a wait on a worker checks progress and cancel
+
+    @staticmethod
+    def runs(pool, workers, mask, angle, step_px, progress=None):
+        # Every run of ScanlineEngine.spans on the BitMask, in order: (scanline, c0, c1)
+        # rows, and the samples of all runs stacked.
+        n = len(ScanlineEngine.frame(mask.shape, angle, step_px)[4])
+        bounds = np.linspace(0, n, workers * ParallelInfill.CHUNKS + 1).astype(int)
+        bits, futures, parts = SharedArray.copy_of(np.asarray(mask.bits)), [], []
+        try:
+            futures = [pool.submit(ParallelInfill._band, bits.spec, mask.width, angle, step_px, a, b)
+                       for a, b in zip(bounds[:-1].tolist(), bounds[1:].tolist()) if b > a]
+            for k, fut in enumerate(futures):
+                parts.append(fut.result())
+                if progress: progress((k + 1) / len(futures))
+        finally:
+            for fut in futures: fut.cancel()
+            bits.close(unlink=True)
+        return np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])
+
+    @staticmethod
+    def spans(meta, xy):
+        # runs() as ScanlineEngine.spans tuples
+        cut = np.cumsum(meta[:, 2] - meta[:, 1])[:-1]
+        for (row, c0, c1), run in zip(meta.tolist(), np.split(xy, cut)):
+            yield row, c0, c1, run[:, 0], run[:, 1]
+
+    @staticmethod
+    def _band(spec, width, angle, step_px, a, b):
+        # Worker: runs of scanlines a..b as (row, c0, c1) rows and their stacked samples,
+        # as int32 to halve what goes back through the pipe.
+        block = SharedArray.attach(spec)
+        try:
+            mask = BitMask(block.array(), width)
+            meta, xy = [], []
+            for row, c0, c1, xs, ys in ScanlineEngine.spans(mask, angle, step_px, lines=range(a, b)):
+                meta.append((row, c0, c1))
+                xy.append(np.column_stack((xs, ys)))
+            del mask
+            return (np.array(meta, np.int64).reshape(-1, 3),
+                    np.concatenate(xy).astype(np.int32) if xy else np.zeros((0, 2), np.int32))
+        finally:
+            block.close()
+
+    @staticmethod
+    def contours(pool, workers, arr, step, metric='taxicab', progress=None):
+        # Same contours as ConcentricEngine.contours. The distance transform and the
+        # labelling stay serial; regions are split into chunks of similar area.
+        dist, labels, objects = ConcentricEngine.regions(arr, metric)
+        if not objects: return
+        area = np.array([(sl[0].stop - sl[0].start) * (sl[1].stop - sl[1].start) for sl in objects])
+        cut = np.searchsorted(np.cumsum(area), np.linspace(0, area.sum(), workers * ParallelInfill.CHUNKS + 1)[1:-1])
+        shared, futures = [SharedArray.copy_of(dist), SharedArray.copy_of(labels)], []
+        try:
+            items = list(enumerate(objects, 1))
+            bounds = [0] + np.unique(cut).tolist() + [len(items)]
+            futures = [pool.submit(ParallelInfill._regions, shared[0].spec, shared[1].spec, items[a:b], step)
+                       for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+            for k, fut in enumerate(futures):
+                # poll rather than block, so progress (and with it cancel) is checked
+                # while one large region is still being traced
+                while not wait((fut,), ParallelInfill.POLL_S).done:
+                    if progress: progress(k / len(futures))
+                yield from fut.result()
+                if progress: progress((k + 1) / len(futures))
+        finally:
+            for fut in futures: fut.cancel()
+            for block in shared: block.close(unlink=True)
+
+    @staticmethod
+    def _regions(dist_spec, labels_spec, items, step):
+        # Worker: every contour of the (label, slice) regions in items.
+        blocks = [SharedArray.attach(dist_spec), SharedArray.attach(labels_spec)]
+        try:
+            dist, labels = (b.array() for b in blocks)
+            out = [ct for lbl, sl in items for ct in ConcentricEngine.region_contours(dist, labels, lbl, sl, step)]
+            del dist, labels
+            return out
+        finally:
+            for block in blocks: block.close()
+
+class PathSimplifier:
+    # Drops repeated and exactly collinear samples, then Ramer-Douglas-Peucker with
+    # tol in mm. Endpoints are kept, so path order and direction are unchanged.
+    # Both passes run over all paths at once.
+    @staticmethod
+    def simplify(paths, tol):
+        if not tol or tol <= 0: return paths
+        return paths.select(PathSimplifier.keep(paths, tol))
+
+    @staticmethod
+    def keep(paths, tol):
+        # Samples that survive simplify; tol 0 only drops repeated and collinear samples.
+        keep = PathSimplifier._merge_collinear(paths)
+        if not tol or tol <= 0: return keep
+        idx = np.flatnonzero(keep)
+        kept = np.zeros(len(keep) + 1, np.int64)
+        np.cumsum(keep, out=kept[1:])
+        o = paths.offsets
+        runs = kept[o[1:]] - kept[o[:-1]] >= 3
+        keep[idx] = PathSimplifier._rdp(paths.xy[idx], kept[o[:-1]][runs], kept[o[1:]][runs] - 1, tol)
+        return keep
+
+    @staticmethod
+    def _merge_collinear(paths):
+        # Samples that survive. A path drops repeated samples (keeping its end if nothing
+        # moves), then, with 3+ left, the ones exactly on a straight run between their
+        # neighbours. Paths under 3 samples stay as they are.
+        xy, o = paths.xy, paths.offsets
+        n, lens = len(xy), np.diff(o)
+        path = np.repeat(np.arange(len(lens)), lens)
+        short = np.repeat(lens < 3, lens)
+        keep = np.ones(n, bool)
+        if n < 2: return keep
+        keep[1:] = np.any(xy[1:] != xy[:-1], axis=1)
+        keep[o[:-1][lens > 0]] = True
+        left = np.bincount(path[keep], minlength=len(lens))
+        still = np.flatnonzero((left == 1) & (lens > 1))
+        keep[o[still + 1] - 1] = True  # nothing moved: first and last
+        keep |= short
+        idx = np.flatnonzero(keep)
+        q, pid = xy[idx], path[idx]
+        d = np.diff(q, axis=0)
+        cross = d[:-1, 0]*d[1:, 1] - d[:-1, 1]*d[1:, 0]
+        turn = (cross != 0) | ((d[:-1]*d[1:]).sum(1) <= 0)
+        inner = (pid[1:-1] == pid[:-2]) & (pid[1:-1] == pid[2:]) & ~short[idx[1:-1]]
+        keep[idx[1:-1][inner & ~turn]] = False
+        return keep
+
+    @staticmethod
+    def _rdp(pts, starts, ends, tol):
+        # Samples of pts that survive RDP within each run pts[starts[i]..ends[i]]; samples
+        # outside the runs all survive. Every open interval of every run is split in the
+        # same round, at its first farthest sample.
+        edge = np.zeros(len(pts) + 1, np.int64)
+        np.add.at(edge, starts + 1, 1)
+        np.add.at(edge, ends, -1)
+        keep = np.cumsum(edge[:-1]) == 0
+        a, b = starts, ends
+        while len(a):
+            open_ = b - a >= 2
+            a, b = a[open_], b[open_]
+            if not len(a): break
+            cnt = b - a - 1
+            first = np.cumsum(cnt) - cnt
+            seg = np.repeat(np.arange(len(a)), cnt)
+            j = np.arange(cnt.sum()) - np.repeat(first, cnt) + np.repeat(a + 1, cnt)
+            rel = pts[j] - pts[a][seg]
+            ab = pts[b] - pts[a]
+            chord = np.fromiter(map(math.hypot, ab[:, 0].tolist(), ab[:, 1].tolist()), np.float64, len(a))
+            c, abs_ = chord[seg], ab[seg]
+            closed = c == 0  # closed contour: measure from the shared endpoint
+            with np.errstate(divide='ignore', invalid='ignore'):
+                dev = np.where(closed, np.hypot(rel[:, 0], rel[:, 1]),
+                               np.abs(rel[:, 0]*abs_[:, 1] - rel[:, 1]*abs_[:, 0]) / c)
+            top = np.maximum.reduceat(dev, first)
+            at = np.flatnonzero(dev == top[seg])
+            _, pick = np.unique(seg[at], return_index=True)
+            m = j[at[pick]]
+            split = top > tol
+            keep[m[split]] = True
+            a, b, m = a[split], b[split], m[split]
+            a, b = np.r_[a, m], np.r_[m, b]
+        return keep
+
+class ArcFitter:
+    # Turns runs of MIN_SEGMENTS or more consecutive lines of a simplified path into
+    # one arc (G2/G3) where every traced sample along the run, and every segment
+    # midpoint between them, is within tol mm of a circle through the run's two ends.
+    # The run must turn one way and sweep at most MAX_SWEEP, so arcs join their
+    # neighbours exactly and never print as a full circle, and each arc saves at
+    # least one line over the simplified path. Each path keeps one cursor; every
+    # round finds the longest arc at all cursors at once, doubling the run and then
+    # bisecting.
+    MIN_SEGMENTS = 2
+    MAX_SWEEP = math.pi
+    MAX_RADIUS = 5000.0  # mm; flatter runs stay lines
+
+    @staticmethod
+    def fit(paths, tol, keep=None):
+        # (paths, arcs): the samples of keep (by default every sample PathSimplifier
+        # would keep at tol 0) that arcs do not pass over, and per sample the segment
+        # that ends there as (centre x, centre y, turn): turn +1 for G3, -1 for G2 and
+        # 0 for a line
+        xy, o = paths.xy, paths.offsets
+        vert = np.flatnonzero(PathSimplifier.keep(paths, 0) if keep is None else keep)
+        n, least = len(vert), ArcFitter.MIN_SEGMENTS
+        path = np.searchsorted(o, vert, 'right') - 1
+        last = np.searchsorted(path, path, 'right') - 1  # each vertex's path's last vertex
+        starts = np.flatnonzero(last - np.arange(n) >= least)
+        starts = starts[ArcFitter._fits(xy, vert[starts], vert[starts + least], tol)[0]]
+        edge = np.zeros(n + 1, np.int64)
+        arcs = np.zeros((len(xy), 3))
+        cur = starts[np.r_[True, last[starts[1:]] != last[starts[:-1]]]] if len(starts) else starts
+        while len(cur):
+            span = last[cur] - cur
+            lo, hi = np.full(len(cur), least), span + 1  # longest fit, shortest misfit
+            grow = lo < span
+            while grow.any():
+                idx = np.flatnonzero(grow)
+                k = np.minimum(2 * lo[idx], span[idx])
+                ok = ArcFitter._fits(xy, vert[cur[idx]], vert[cur[idx] + k], tol)[0]
+                lo[idx[ok]], hi[idx[~ok]] = k[ok], k[~ok]
+                grow[idx] = ok & (k < span[idx])
+            while True:
+                idx = np.flatnonzero(hi - lo > 1)
+                if not len(idx): break
+                k = (lo[idx] + hi[idx]) // 2
+                ok = ArcFitter._fits(xy, vert[cur[idx]], vert[cur[idx] + k], tol)[0]
+                lo[idx[ok]], hi[idx[~ok]] = k[ok], k[~ok]
+            end = cur + lo
+            arcs[vert[end]] = np.column_stack(ArcFitter._fits(xy, vert[cur], vert[end], tol)[1:])
+            np.add.at(edge, cur + 1, 1)
+            np.add.at(edge, end, -1)
+            nxt = np.searchsorted(starts, end)  # next cursor: the first start from the arc's end
+            ok = nxt < len(starts)
+            nxt, end = nxt[ok], end[ok]
+            cur = starts[nxt][last[starts[nxt]] == last[end]]
+        out = np.zeros(len(xy), bool)
+        out[vert[np.cumsum(edge[:-1]) == 0]] = True
+        return paths.select(out), arcs[out]
+
+    @staticmethod
+    def _fits(xy, a, b, tol):
+        # (ok, centre x, centre y, turn) for the runs xy[a[i]..b[i]]. The centre lies on
+        # the bisector of the run's chord, at the offset t that fits the run's samples
+        # best in the algebraic sense: |p - c|^2 - r^2 is linear in t there.
+        p0, p1 = xy[a], xy[b]
+        mid, half = (p0 + p1) / 2, (p1 - p0) / 2
+        cnt = b - a
+        if not len(cnt): return np.zeros(0, bool), mid[:, 0], mid[:, 1], np.zeros(0)
+        first = np.cumsum(cnt) - cnt
+        seg = np.repeat(np.arange(len(a)), cnt)
+        j = np.arange(cnt.sum()) - np.repeat(first, cnt) + np.repeat(a, cnt)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            hh = (half*half).sum(1)
+            normal = np.column_stack((-half[:, 1], half[:, 0])) / np.sqrt(hh)[:, None]
+            rel = xy[j] - mid[seg]
+            w = (rel * normal[seg]).sum(1)
+            e = (rel*rel).sum(1) - hh[seg]
+            t = np.add.reduceat(e * w, first) / (2 * np.add.reduceat(w * w, first))
+            cx, cy = mid[:, 0] + t*normal[:, 0], mid[:, 1] + t*normal[:, 1]
+            r = np.sqrt(hh + t*t)
+            turn = -np.sign(np.add.reduceat(w, first))  # bulging left of the chord turns clockwise
+            c = np.column_stack((cx, cy))[seg]
+            p, q = xy[j] - c, xy[j + 1] - c
+            rr = r[seg]
+            dev = np.maximum(np.abs(np.hypot(q[:, 0], q[:, 1]) - rr),
+                             np.abs(np.hypot(p[:, 0] + q[:, 0], p[:, 1] + q[:, 1]) / 2 - rr))
+            step = np.arctan2(p[:, 0]*q[:, 1] - p[:, 1]*q[:, 0], (p*q).sum(1)) * turn[seg]
+            ok = ((r <= ArcFitter.MAX_RADIUS) & (np.maximum.reduceat(dev, first) <= tol) &
+                  (np.minimum.reduceat(step, first) > 0) & (np.add.reduceat(step, first) <= ArcFitter.MAX_SWEEP))
+        return ok, cx, cy, turn
+
+    @staticmethod
+    def sweep(x0, y0, x1, y1, cx, cy, turn):
+        # (radius, start angle, swept angle) of the arc from (x0, y0) to (x1, y1) around
+        # (cx, cy); ending where it starts sweeps a full circle, as on the controller
+        a0 = math.atan2(y0 - cy, x0 - cx)
+        swept = (turn * (math.atan2(y1 - cy, x1 - cx) - a0)) % (2 * math.pi)
+        return math.hypot(x0 - cx, y0 - cy), a0, swept or 2 * math.pi
+
+    @staticmethod
+    def reverse(arcs):
+        # arcs of a path drawn backwards: each segment moves to its other end and turns the other way
+        out = np.zeros_like(arcs)
+        out[1:] = arcs[:0:-1]
+        out[:, 2] *= -1
+        return out
+
+    @staticmethod
+    def path_lengths(paths, arcs):
+        # PathSet.path_lengths with arc segments measured along the arc
+        lengths = paths.path_lengths()
+        rows = np.flatnonzero(arcs[:, 2])
+        if len(rows):
+            a, b, c = paths.xy[rows - 1], paths.xy[rows], arcs[rows]
+            r = np.hypot(a[:, 0] - c[:, 0], a[:, 1] - c[:, 1])
+            cross = (a[:, 0]-c[:, 0])*(b[:, 1]-c[:, 1]) - (a[:, 1]-c[:, 1])*(b[:, 0]-c[:, 0])
+            dot = ((a - c[:, :2]) * (b - c[:, :2])).sum(1)
+            extra = r * np.mod(np.arctan2(cross * c[:, 2], dot), 2 * np.pi) - np.hypot(*(b - a).T)
+            lengths += np.bincount(np.searchsorted(paths.offsets, rows, 'right') - 1, extra, len(paths))
+        return lengths
+
+_f3 = '%.3f'.__mod__
+
+class GcodeWriter:
+    # Tracks modal state (feed, acceleration, X/Y/Z as emitted) and only writes what
+    # changes it. Feed and acceleration requests stay pending until the next real move,
+    # so one that is overridden or unused costs nothing. M204 is queued in order by
+    # Marlin, Klipper and RepRapFirmware, so the M400 drain ahead of it is opt-in
+    # (accel_sync). Positions compare in their printed 3-decimal form.
+    def __init__(self, accel_sync=False):
+        self.lines = []
+        self.accel_sync = accel_sync
+        self.x = self.y = self.z = None
+        self.feed = self.accel = None
+        self.want_feed = self.want_accel = None
+
+    def raw(self, *lines):
+        self.lines.extend(lines)
+
+    def motion(self, feed, accel):
+        self.want_feed, self.want_accel = feed, accel
+
+    def move(self, cmd, x=None, y=None, z=None, f=None):
+        if f is not None: self.want_feed = f
+        words = []
+        if x is not None:
+            sx = _f3(x)
+            if sx != self.x: words.append('X' + sx); self.x = sx
+        if y is not None:
+            sy = _f3(y)
+            if sy != self.y: words.append('Y' + sy); self.y = sy
+        if z is not None:
+            sz = _f3(z)
+            if sz != self.z: words.append('Z' + sz); self.z = sz
+        if words: self._emit(cmd, words)
+
+    def arc(self, cmd, x, y, cx, cy):
+        # G2/G3 to (x, y) around (cx, cy), with I and J measured from the position as
+        # printed. An arc whose sagitta is below the printed resolution goes out as G1:
+        # the line is as close, and rounding cannot turn it into a near-full circle.
+        x0, y0 = float(self.x), float(self.y)
+        if (x - x0)**2 + (y - y0)**2 < 0.008 * math.hypot(cx - x0, cy - y0):
+            return self.move('G1', x, y)
+        self.x, self.y = _f3(x), _f3(y)
+        self._emit(cmd, ['X' + self.x, 'Y' + self.y, 'I' + _f3(cx - x0), 'J' + _f3(cy - y0)])
+
+    def _emit(self, cmd, words):
+        if self.want_accel is not None and self.want_accel != self.accel:
+            if self.accel_sync: self.lines.append("M400")
+            self.lines.append(f"M204 P{self.want_accel} T{self.want_accel}")
+            self.accel = self.want_accel
+        if self.want_feed is not None and self.want_feed != self.feed:
+            words.append(f"F{self.want_feed}")
+            self.feed = self.want_feed
+        self.lines.append(cmd + ' ' + ' '.join(words))
+
+    def polyline(self, cmd, xy):
+        # move(cmd, x, y) for every row of xy, formatted in bulk. A coordinate that moved
+        # by 0.002 or more prints differently and one that didn't move prints the same;
+        # only the few in between are compared as printed text.
+        if len(xy) and ((self.want_accel is not None and self.want_accel != self.accel) or
+                        (self.want_feed is not None and self.want_feed != self.feed)):
+            self.move(cmd, *xy[0].tolist())
+            xy = xy[1:]
+        n = len(xy)
+        if not n: return
+        printed = ('%.3f ' * (2*n) % tuple(xy.ravel().tolist())).split()
+        last = [float(v) if v is not None else np.nan for v in (self.x, self.y)]
+        delta = np.abs(np.diff(np.vstack((last, xy)), axis=0))
+        changed = ~(delta < 0.002)
+        for k, a in zip(*np.nonzero((delta > 0) & (delta < 0.002))):
+            changed[k, a] = printed[2*k + a] != (printed[2*k - 2 + a] if k else (self.x, self.y)[a])
+        kind = changed[:, 0] + 2*changed[:, 1]
+        templates = np.array([None, cmd + ' X%s', cmd + ' Y%s', cmd + ' X%s Y%s'], object)[kind[kind > 0]]
+        if len(templates):
+            args = np.array(printed, object)[changed.ravel()]
+            self.lines.extend(("\n".join(templates.tolist()) % tuple(args.tolist())).split("\n"))
+        self.x, self.y = printed[-2], printed[-1]
+
+    def drain(self):
+        lines, self.lines = self.lines, []
+        return lines
 
 class UltraPainter:
-    def __init__(self, cfg):
+    RES = 2.0         # raster px per mm
+    THRESHOLD = 140   # grey levels below this are paint
+    PAINT_BATCH = 16     # shorter stretches of a path go through the per-point loop
+    PAINT_WINDOW = 4096  # segments summed per cumsum
+    DIP_FILL = 0.9       # dip schedule: share of a load to use before dipping early
+
+    def __init__(self, cfg, progress=None):
         self.cfg = cfg
-        self.gcode = []
+        self.res = float(cfg.get('res') or self.RES)
+        self.tile = int(cfg.get('tile') or 0)
+        self.memmap = cfg.get('mask_store') == 'memmap'
+        self.progress = progress or (lambda stage, frac: None)
+        self.stats = {'paths': 0, 'points': 0, 'dips': 0, 'splits': 0, 'gcode_lines': 0, 'cache_hit': False}
+        self.gcode = GcodeWriter(cfg.get('accel_sync', False))
+        self.regions = None  # region id per traced zig-zag stroke
         self.dist_since_dip = 0
         self.current_pos = (cfg['dip_x'], cfg['dip_y'])
-        self.current_max_dist = random.uniform(cfg['min_dist'], cfg['max_dist'])
+        self.rng = random.Random(cfg.get('seed'))
+        self.current_max_dist = self.rng.uniform(cfg['min_dist'], cfg['max_dist'])
+
+    @contextmanager
+    def _timed(self, stage):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stats[stage + '_s'] = self.stats.get(stage + '_s', 0.0) + time.perf_counter() - t
 
     def _set_speed(self, mode='travel'):
         c = self.cfg
         accel = c['accel_travel'] if mode == 'travel' else c['accel_paint']
         feed  = c['feed']        if mode == 'travel' else c['feed_paint']
-        self.gcode.append("M400")
-        self.gcode.append(f"M204 P{accel} T{accel}")
-        self.gcode.append(f"G1 F{feed}")
+        self.gcode.motion(feed, accel)
 
     def _perform_dip_and_travel(self, target_x, target_y):
-        c = self.cfg
-        self.gcode.append(f"\n; --- CIKEL NAMAKANJA ---")
-        self.gcode.append(f"G0 Z{c['z_low']:.3f} F3000")
+        c, g = self.cfg, self.gcode
+        g.raw("\n; --- CIKEL NAMAKANJA ---")
+        g.move('G0', z=c['z_low'], f=3000)
         self._set_speed('travel')
-        ax = c['dip_x'] + random.uniform(-c['dip_jitter'], c['dip_jitter'])
-        ay = c['dip_y'] + random.uniform(-c['dip_jitter'], c['dip_jitter'])
-        self.gcode.append(f"G0 X{ax:.3f} Y{ay:.3f} Z{c['z_high']:.3f}")
-        self.gcode.append(f"G1 Z{c['dip_z']:.3f} F3000")
+        ax = c['dip_x'] + self.rng.uniform(-c['dip_jitter'], c['dip_jitter'])
+        ay = c['dip_y'] + self.rng.uniform(-c['dip_jitter'], c['dip_jitter'])
+        g.move('G0', ax, ay, c['z_high'])
+        g.move('G1', z=c['dip_z'], f=3000)
         num_steps = int(c['dip_spiral_loops'] * 4)
         for i in range(num_steps):
             ang = i * (math.pi / 2)
             r = (i / num_steps) * c['dip_spiral_r']
-            self.gcode.append(f"G1 X{ax + r*math.cos(ang):.3f} Y{ay + r*math.sin(ang):.3f} F2500")
+            g.move('G1', ax + r*math.cos(ang), ay + r*math.sin(ang), f=2500)
         dx, dy = target_x - c['dip_x'], target_y - c['dip_y']
         dist = math.hypot(dx, dy)
         wx = c['dip_x'] + (dx/dist * c['wipe_r']) if dist > 0 else c['dip_x'] + c['wipe_r']
         wy = c['dip_y'] + (dy/dist * c['wipe_r']) if dist > 0 else c['dip_y']
-        self.gcode.append(f"G0 Z{c['z_wipe_exit']:.3f} F3000")
-        self.gcode.append(f"G0 X{wx:.3f} Y{wy:.3f}")
-        self.gcode.append(f"G0 Z{c['z_high']:.3f} F3000")
-        self.gcode.append(f"G0 X{target_x:.3f} Y{target_y:.3f} Z{c['z_low']:.3f}")
+        g.move('G0', z=c['z_wipe_exit'], f=3000)
+        g.move('G0', wx, wy)
+        g.move('G0', z=c['z_high'], f=3000)
+        g.move('G0', target_x, target_y, c['z_low'])
         self.dist_since_dip = 0
-        self.current_max_dist = random.uniform(c['min_dist'], c['max_dist'])
+        self.current_max_dist = self.rng.uniform(c['min_dist'], c['max_dist'])
         self.current_pos = (target_x, target_y)
+        self.stats['dips'] += 1
 
-    def generate_paths(self, img_path):
+    @staticmethod
+    def binarize(gray):
+        return np.asarray(gray) < UltraPainter.THRESHOLD
+
+    def binary_mask(self, img_path):
+        # Full-resolution binarized image as a BitMask, cached; /upload_preview stores
+        # it on upload so generation skips decoding the file again.
+        c = self.cfg
+        key = PLAN_CACHE.key('bitmask', image_digest(img_path))
+        hit = PLAN_CACHE.get(key) if c.get('cache', True) else None
+        if hit is not None:
+            return BitMask.from_entry(hit)
+        with self._timed('decode'):
+            gray = Image.open(img_path).convert('L')
+        with self._timed('threshold'):
+            mask = BitMask.pack(self.binarize(gray))
+        if c.get('cache', True): PLAN_CACHE.put(key, mask.entry())
+        return mask
+
+    def load_mask(self, img_path):
+        # The canvas raster at self.res px/mm, flipped so +Y is up, as a BitMask. It is
+        # resampled a band at a time, to the same pixels as a PIL NEAREST resize.
+        c = self.cfg
+        key = PLAN_CACHE.key('mask', image_digest(img_path), *[c.get(k) for k in MASK_KEYS])
+        hit = PLAN_CACHE.get(key) if c.get('cache', True) else None
+        if hit is not None:
+            return BitMask.from_entry(hit)
+        self.progress('load', 0.0)
+        src = self.binary_mask(img_path)
+        with self._timed('resize'):
+            h, w = src.shape
+            tw = int(c['target_width'] * self.res)
+            th = int(c['target_width'] * (h / w) * self.res)
+            mask = src.resample(h - 1 - nearest_index(h, th), nearest_index(w, tw), self.memmap)
+        if c.get('cache', True): PLAN_CACHE.put(key, mask.entry())
+        return mask
+
+    def trace_paths(self, mask):
+        # Tiled mode keeps the canvas packed: scanlines sample its bits directly and
+        # concentric levels are traced tile by tile. Zig-zag also records the region
+        # of each stroke in self.regions. With infill_workers > 1, scanline bands or
+        # concentric regions are traced over a process pool (untiled concentric only).
         c = self.cfg
-        img = Image.open(img_path).convert('L').transpose(Image.FLIP_TOP_BOTTOM)
-        img = img.point(lambda p: 0 if p < 140 else 255)
-        res = 2.0
-        tw = int(c['target_width'] * res)
-        th = int(c['target_width'] * (img.height / img.width) * res)
-        img = img.resize((tw, th), Image.Resampling.NEAREST)
-        arr = np.array(img) < 140
-        raw_paths = []
+        res = self.res
+        arrays, paths = [], None
         step_px = int((c['brush_w'] * (1 - c['overlap'])) * res)
+        infill = lambda frac: self.progress('infill', frac)
+        metric = c.get('concentric_metric', 'taxicab')
+        angle = c.get('infill_angle', 0)
+        arr = mask if self.tile else mask.unpack()
+        workers = int(c.get('infill_workers') or 1)
+        pool = layer_pool(workers) if workers > 1 else None
 
         if c['infill_type'] == 'concentric':
-            temp_arr = arr.copy()
-            erosion_steps = max(1, step_px)
-            max_iters = 2000
-            iteration = 0
-            while temp_arr.any() and iteration < max_iters:
-                iteration += 1
-                contours = measure.find_contours(temp_arr.astype(np.float32), 0.5)
-                for contour in contours:
-                    path = [(pt[1]/res + c['x_off'], pt[0]/res + c['y_off']) for pt in contour]
-                    if len(path) > 2:
-                        raw_paths.append(path)
-                eroded = ndimage.binary_erosion(temp_arr, iterations=erosion_steps)
-                if not eroded.any():
-                    break
-                temp_arr = eroded
+            if self.tile:
+                contours = ConcentricEngine.tiled_contours(mask, max(1, step_px), metric, self.tile, self.memmap, infill)
+            elif pool:
+                contours = ParallelInfill.contours(pool, workers, arr, max(1, step_px), metric, infill)
+            else:
+                contours = ConcentricEngine.contours(arr, max(1, step_px), metric, infill)
+            for ct in contours:
+                if len(ct) > 2: arrays.append(ct[:, ::-1])  # (row, col) -> (x, y)
+        elif pool:
+            meta, xy = ParallelInfill.runs(pool, workers, mask, angle, step_px, infill)
+            if c['infill_type'] == 'zigzag':
+                arrays, self.regions = ScanlineEngine.zigzag(arr, angle, step_px, None, ParallelInfill.spans(meta, xy))
+            else:
+                offsets = np.zeros(len(meta) + 1, np.int64)
+                np.cumsum(meta[:, 2] - meta[:, 1], out=offsets[1:])
+                paths = PathSet(xy.astype(np.float64), offsets)
+        elif c['infill_type'] == 'zigzag':
+            arrays, self.regions = ScanlineEngine.zigzag(arr, angle, step_px, infill)
         else:
-            angle_rad = math.radians(c.get('infill_angle', 0))
-            cos_a, sin_a = math.cos(angle_rad), math.sin(angle_rad)
-            h, w = arr.shape
-            cx, cy = w / 2.0, h / 2.0
-            diag = int(math.hypot(w, h)) + 10
-            for y_rot in range(-diag, diag, max(1, step_px)):
-                line = []
-                for x_rot in range(-diag, diag):
-                    orig_x = int(cx + x_rot * cos_a - y_rot * sin_a)
-                    orig_y = int(cy + x_rot * sin_a + y_rot * cos_a)
-                    if 0 <= orig_x < w and 0 <= orig_y < h and arr[orig_y, orig_x]:
-                        line.append((orig_x/res + c['x_off'], orig_y/res + c['y_off']))
-                    else:
-                        if len(line) > 1: raw_paths.append(line)
-                        line = []
-                if len(line) > 1: raw_paths.append(line)
-
-        return PathOptimizer.optimize(raw_paths, (c['dip_x'], c['dip_y']))
-
-    def generate(self, img_path, append_to=None):
-        if append_to is None:
-            self.gcode = ["G90", "G21"]
-        else:
-            self.gcode = append_to
+            arrays = [np.column_stack((xs, ys)) for _, _, _, xs, ys in ScanlineEngine.spans(arr, angle, step_px, infill)]
+        if paths is None: paths = PathSet.from_arrays(arrays)
+        paths.xy /= res
+        paths.xy += (c['x_off'], c['y_off'])
+        return paths
 
+    def generate_paths(self, img_path):
+        # Geometry depends only on the image and PATH_KEYS, so motion-only changes hit the cache.
+        c = self.cfg
+        key = PLAN_CACHE.key('paths', image_digest(img_path), *[c.get(k) for k in PATH_KEYS])
+        hit = PLAN_CACHE.get(key) if c.get('cache', True) else None
+        if hit is not None:
+            self.stats['cache_hit'] = True
+            return PathSet.from_entry(hit)
+        arr = self.load_mask(img_path)
+        with self._timed('infill'):
+            raw_paths = self.trace_paths(arr)
+        regions = self.regions if c.get('region_order') else None
+        with self._timed('optimize'):
+            paths = PathOptimizer.optimize(raw_paths, (c['dip_x'], c['dip_y']), c.get('opt_refine_time', 0),
+                                           lambda frac: self.progress('optimize', frac), regions)
+        if c.get('cache', True): PLAN_CACHE.put(key, paths.entry())
+        return paths
+
+    def generate(self, img_path, header=True):
+        # Yields G-code lines; the writer only buffers the moves of the path in progress.
+        if header: yield from ("G90", "G21")
+        c = self.cfg
         paths = self.generate_paths(img_path)
+        tol = c.get('simplify_tol', 0)
+        if not c.get('arc_tol'):
+            with self._timed('simplify'):
+                paths = PathSimplifier.simplify(paths, tol)
+            yield from self.emit(paths)
+            return
+        # Arcs replace runs of the simplified lines, checked against the traced samples
+        # they pass over.
+        with self._timed('simplify'):
+            keep = PathSimplifier.keep(paths, tol)
+        with self._timed('arcfit'):
+            paths, arcs = ArcFitter.fit(paths, float(c['arc_tol']), keep)
+        self.stats['arcs'] = self.stats.get('arcs', 0) + int(np.count_nonzero(arcs[:, 2]))
+        self.stats['arc_lines_saved'] = self.stats.get('arc_lines_saved', 0) + int(keep.sum()) - paths.n_points
+        yield from self.emit(paths, arcs)
+
+    def _paint(self, pts):
+        # The brush is down at pts[0]. While the dip budget left covers many segments,
+        # a window of segment lengths is summed with cumsum, searchsorted finds where
+        # the budget runs out, and the points before that go to the writer in one
+        # batch. The point that crosses the budget takes the per-point path: paint up
+        # to the budget, dip, resume. Lengths come from math.hypot and are summed in
+        # the same order as before, so splits land on exactly the same coordinates.
+        # A budget of 0 or less never splits: the path is painted on one load.
+        g = self.gcode
+        n, i = len(pts), 1
+        xy = pts.tolist() if n <= 4 * self.PAINT_BATCH else None  # long paths mostly go in batches
+        while i < n:
+            (cx, cy), (px, py) = (xy[i-1], xy[i]) if xy else pts[i-1:i+1].tolist()
+            dist = math.hypot(px-cx, py-cy)
+            budget = self.current_max_dist - self.dist_since_dip
+            if n - i >= self.PAINT_BATCH and budget > self.PAINT_BATCH * dist:
+                # about twice the segments the budget should last, judging by this one
+                w = self.PAINT_WINDOW if dist == 0 else min(self.PAINT_WINDOW, int(2 * budget / dist) + 1)
+                seg = np.diff(pts[i-1:i+w], axis=0)
+                cum = np.empty(len(seg) + 1)
+                cum[0] = self.dist_since_dip
+                cum[1:] = np.fromiter(map(math.hypot, seg[:, 0].tolist(), seg[:, 1].tolist()), np.float64, len(seg))
+                np.cumsum(cum, out=cum)
+                j = int(np.searchsorted(cum[1:], self.current_max_dist, side='right'))
+                g.polyline('G1', pts[i:i+j])
+                self.dist_since_dip = float(cum[j])
+                i += j
+                continue
+            while self.current_max_dist > 0 and (self.dist_since_dip + dist) > self.current_max_dist:
+                t = (self.current_max_dist - self.dist_since_dip) / dist
+                qx, qy = cx + (px-cx)*t, cy + (py-cy)*t
+                if t > 0: g.move('G1', qx, qy)
+                self._split(qx, qy)
+                cx, cy = qx, qy
+                dist = math.hypot(px-qx, py-qy)
+            g.move('G1', px, py)
+            self.dist_since_dip += dist
+            i += 1
+        self.current_pos = tuple(pts[-1].tolist())
+
+    def _paint_arcs(self, pts, arcs):
+        # _paint for a path with arcs, a segment at a time. An arc counts its length
+        # along the arc toward the dip budget, and when the budget runs out inside it
+        # the arc is cut at that point, so the brush dips exactly where a polyline
+        # following the arc would.
+        g = self.gcode
+        xy, arcs = pts.tolist(), arcs.tolist()
+        for (sx, sy), (px, py), (ox, oy, turn) in zip(xy, xy[1:], arcs[1:]):
+            if not turn:
+                dist = math.hypot(px-sx, py-sy)
+                while self.current_max_dist > 0 and (self.dist_since_dip + dist) > self.current_max_dist:
+                    t = (self.current_max_dist - self.dist_since_dip) / dist
+                    qx, qy = sx + (px-sx)*t, sy + (py-sy)*t
+                    if t > 0: g.move('G1', qx, qy)
+                    self._split(qx, qy)
+                    sx, sy = qx, qy
+                    dist = math.hypot(px-qx, py-qy)
+                g.move('G1', px, py)
+            else:
+                cmd = 'G3' if turn > 0 else 'G2'
+                r, a, swept = ArcFitter.sweep(sx, sy, px, py, ox, oy, turn)
+                dist = r * swept
+                while self.current_max_dist > 0 and (self.dist_since_dip + dist) > self.current_max_dist:
+                    left = self.current_max_dist - self.dist_since_dip
+                    a += turn * left / r
+                    qx, qy = ox + r*math.cos(a), oy + r*math.sin(a)
+                    if left > 0: g.arc(cmd, qx, qy, ox, oy)
+                    self._split(qx, qy)
+                    dist -= left
+                g.arc(cmd, px, py, ox, oy)
+            self.dist_since_dip += dist
+        self.current_pos = tuple(xy[-1])
+
+    def _split(self, qx, qy):
+        # the load ran out at (qx, qy) mid-stroke: lift, dip, and put the brush back down there
+        c, g = self.cfg, self.gcode
+        g.move('G0', z=c['z_low'], f=3000)
+        self._perform_dip_and_travel(qx, qy)
+        self.stats['splits'] += 1
+        self._set_speed('paint')
+        g.move('G1', z=c['z_paint'], f=2500)
+
+    def _travel_strokes(self, paths):
+        # Travel schedule: the optimizer's order, dipping wherever the load runs out.
+        self._perform_dip_and_travel(*paths.xy[0].tolist())
+        yield from ((p, 0) for p in range(len(paths)))
+
+    def _travel_dips(self, lengths):
+        # Dips the travel schedule would make from here: the same budget draws, with the
+        # load split wherever the running stroke length crosses one.
+        c = self.cfg
+        rng = random.Random()
+        rng.setstate(self.rng.getstate())
+        jitter = lambda: rng.uniform(-c['dip_jitter'], c['dip_jitter'])
+        draw = lambda: (jitter(), jitter(), rng.uniform(c['min_dist'], c['max_dist']))[2]
+        budget, since, dips = draw(), 0.0, 1  # every layer starts with a dip
+        for length in lengths.tolist():
+            while budget > 0 and since + length > budget:
+                length -= budget - since
+                budget, since, dips = draw(), 0.0, dips + 1
+            since += length
+        return dips
+
+    def _dip_strokes(self, paths, lengths=None):
+        # Dip schedule: whole strokes packed into dip loads. After a dip the brush starts
+        # on the stroke nearest the dish, then keeps taking the nearest stroke that fits
+        # the paint left. When none does, it finishes the nearest stroke that still ends
+        # within max_dist and closes the load there. Failing that it dips early once the
+        # load is dip_fill used, and otherwise splits the nearest stroke as the travel
+        # schedule would.
+        c, st = self.cfg, self.stats
+        dish = (c['dip_x'], c['dip_y'])
+        fill = float(c.get('dip_fill', self.DIP_FILL))
+        sched = DipScheduler(paths, lengths)
+        travel_dips, dips = self._travel_dips(sched.length), st['dips']
+        pick, stretched = sched.pick(dish), False
+        self._perform_dip_and_travel(*sched.ends[2*pick[0] + pick[1]].tolist())
+        while pick is not None:
+            yield pick
+            if stretched: self.current_max_dist, stretched = self.dist_since_dip, False
+            left = self.current_max_dist - self.dist_since_dip
+            pick = sched.pick(self.current_pos, left) if left > 0 else None
+            if pick is not None or not sched.left: continue
+            if left > 0:
+                pick = sched.pick(self.current_pos, c['max_dist'] - self.dist_since_dip)
+            if pick is not None:
+                self.current_max_dist, stretched = c['max_dist'], True
+            elif left > (1 - fill) * self.current_max_dist:
+                pick = sched.pick(self.current_pos)
+            else:
+                pick = sched.pick(dish)
+                self._perform_dip_and_travel(*sched.ends[2*pick[0] + pick[1]].tolist())
+        st['dips_saved'] = st.get('dips_saved', 0) + travel_dips - (st['dips'] - dips)
+
+    def emit(self, paths, arcs=None):
+        # arcs: per point of paths, the arc ending there as from ArcFitter.fit, if any
+        c, g, st = self.cfg, self.gcode, self.stats
+        st['paths'] += len(paths)
+        st['points'] += paths.n_points
+        st.setdefault('emit_s', 0.0)
+        clock = time.perf_counter()
         if paths:
-            self._perform_dip_and_travel(paths[0][0][0], paths[0][0][1])
-            for path in paths:
-                dist_to_start = math.hypot(path[0][0]-self.current_pos[0], path[0][1]-self.current_pos[1])
-                dist_to_end   = math.hypot(path[-1][0]-self.current_pos[0], path[-1][1]-self.current_pos[1])
-                if dist_to_end < dist_to_start: path = path[::-1]
+            if c.get('schedule') != 'dips':
+                strokes = self._travel_strokes(paths)
+            else:
+                strokes = self._dip_strokes(paths, None if arcs is None else ArcFitter.path_lengths(paths, arcs))
+            o = paths.offsets.tolist()
+            for n, (p, flip) in enumerate(strokes):
+                if n % 256 == 0: self.progress('emit', n / len(paths))
+                path = paths.xy[o[p]:o[p+1]][::-1] if flip else paths.xy[o[p]:o[p+1]]
+                x0, y0 = path[0].tolist()
                 self._set_speed('travel')
-                self.gcode.append(f"G0 X{path[0][0]:.3f} Y{path[0][1]:.3f} Z{self.cfg['z_low']:.3f}")
+                g.move('G0', x0, y0, c['z_low'])
                 self._set_speed('paint')
-                self.gcode.append(f"G1 Z{self.cfg['z_paint']:.3f} F2500")
-                self.current_pos = path[0]
-                for i in range(1, len(path)):
-                    px, py = path[i]
-                    dist = math.hypot(px-self.current_pos[0], py-self.current_pos[1])
-                    if (self.dist_since_dip + dist) > self.current_max_dist:
-                        self.gcode.append(f"G0 Z{self.cfg['z_low']:.3f} F3000")
-                        self._perform_dip_and_travel(px, py)
-                        self._set_speed('paint')
-                        self.gcode.append(f"G1 Z{self.cfg['z_paint']:.3f} F2500")
-                    self.gcode.append(f"G1 X{px:.3f} Y{py:.3f}")
-                    self.dist_since_dip += dist
-                    self.current_pos = (px, py)
-                self.gcode.append(f"G0 Z{self.cfg['z_low']:.3f} F3000")
-        return self.gcode
+                g.move('G1', z=c['z_paint'], f=2500)
+                arc = None if arcs is None else arcs[o[p]:o[p+1]]
+                if arc is not None and arc[:, 2].any():
+                    self._paint_arcs(path, ArcFitter.reverse(arc) if flip else arc)
+                else:
+                    self._paint(path)
+                g.move('G0', z=c['z_low'], f=3000)
+                lines = g.drain()
+                st['gcode_lines'] += len(lines)
+                st['emit_s'] += time.perf_counter() - clock
+                yield from lines
+                clock = time.perf_counter()
+        self.progress('emit', 1.0)
+        lines = g.drain()
+        st['gcode_lines'] += len(lines)
+        st['emit_s'] += time.perf_counter() - clock
+        yield from lines
+
+
+# ─────────────────────────────────────────────
+# ESTIMATE
+# ─────────────────────────────────────────────
+
+class TimeEstimator:
+    # Trapezoidal motion model over an emitted program with a look-ahead planner:
+    # junction speeds follow Marlin's junction-deviation rule, then forward/backward
+    # passes bound every entry and exit speed by what acceleration allows. Moves are
+    # planned in windows of WINDOW moves that start and end at rest.
+    # Moves fall into phases: dip (from a dip marker through its return from the dish,
+    # the first XY move that descends, as in ToolpathPreview), paint (XY at z_paint),
+    # z (Z-only lifts and plunges) and travel (everything else).
+    # G2/G3 arcs are one move as long as the arc, joined to their neighbours along its
+    # end tangents, with speed capped where centripetal acceleration v^2/r reaches
+    # the acceleration limit.
+    PHASES = ('paint', 'travel', 'z', 'dip')
+    WINDOW = 8192
+
+    def __init__(self, cfg):
+        self.z_paint = float(cfg.get('z_paint', 0))
+        self.feed, self.accel = float(cfg.get('feed', 12000)), float(cfg.get('accel_travel', 12000))
+        self.jd = float(cfg.get('junction_deviation', 0.05))
+        self.x = self.y = self.z = 0.0
+        self.in_dip = False
+        self.total = self._bucket()
+        self.layers = OrderedDict()
+        self.layer = None
+        self.moves, self.tags, self.arcs = [], [], []
+
+    @staticmethod
+    def _bucket():
+        return {'time_s': 0.0, **{p + '_s': 0.0 for p in TimeEstimator.PHASES},
+                'paint_mm': 0.0, 'travel_mm': 0.0, 'dips': 0, 'z_lifts': 0, 'lines': 0}
+
+    def _add(self, key, value):
+        self.total[key] += value
+        if self.layer is not None: self.layer[key] += value
+
+    def add_lines(self, lines):
+        for block in lines:
+            for line in block.split("\n") if "\n" in block else (block,):
+                self.add(line)
+
+    def add(self, line):
+        if not line or line[0] == ';':
+            if line.startswith('; LAYER '):
+                self.layer = self.layers.setdefault(line[2:].strip(), self._bucket())
+            elif 'CIKEL NAMAKANJA' in line:
+                self.in_dip = True
+                self._add('dips', 1)
+            return
+        self._add('lines', 1)
+        words = line.split()
+        cmd = words[0]
+        if cmd == 'M204':
+            self.accel = float(words[1][1:])
+            return
+        if cmd not in ('G0', 'G1', 'G2', 'G3'): return
+        x, y, z = self.x, self.y, self.z
+        ci = cj = 0.0
+        for w in words[1:]:
+            k = w[0]
+            if k == 'X': x = float(w[1:])
+            elif k == 'Y': y = float(w[1:])
+            elif k == 'Z': z = float(w[1:])
+            elif k == 'F': self.feed = float(w[1:])
+            elif k == 'I': ci = float(w[1:])
+            elif k == 'J': cj = float(w[1:])
+        dx, dy, dz = x - self.x, y - self.y, z - self.z
+        if cmd in ('G2', 'G3') and (ci or cj):
+            turn = 1 if cmd == 'G3' else -1
+            r, a0, swept = ArcFitter.sweep(self.x, self.y, x, y, self.x + ci, self.y + cj, turn)
+            xy = r * swept
+            a1 = a0 + turn * swept
+            length = math.hypot(xy, dz)
+            tin = (-turn * math.sin(a0) * xy / length, turn * math.cos(a0) * xy / length, dz / length)
+            tout = (-turn * math.sin(a1) * xy / length, turn * math.cos(a1) * xy / length, dz / length)
+            self.arcs.append((len(self.moves), length, *tin, *tout, math.sqrt(self.accel * r)))
+            if dx == 0 and dy == 0 and dz == 0: dx = 2 * r  # full circle: any non-zero chord
+        else:
+            if dx == 0 and dy == 0 and dz == 0: return
+            xy = math.hypot(dx, dy)
+        if self.in_dip:
+            # the dish plunge and spiral can sit at z_paint, so only the return ends it
+            phase = 'dip'
+            if xy and dz < 0: self.in_dip = False
+        elif xy == 0:
+            phase = 'z'
+            if dz > 0: self._add('z_lifts', 1)
+        elif cmd != 'G0' and abs(z - self.z_paint) < 1e-6 and dz == 0:
+            phase = 'paint'
+            self._add('paint_mm', xy)
+        else:
+            phase = 'travel'
+            self._add('travel_mm', xy)
+        self.moves.append((dx, dy, dz, self.feed / 60.0, self.accel))
+        self.tags.append((phase + '_s', self.layer))
+        self.x, self.y, self.z = x, y, z
+        if len(self.moves) >= self.WINDOW: self._flush()
+
+    def _flush(self):
+        if not self.moves: return
+        m = np.array(self.moves)
+        d = np.sqrt((m[:, :3] ** 2).sum(1))
+        u_in = u_out = m[:, :3] / d[:, None]
+        v, a = np.maximum(m[:, 3], 1e-9), np.maximum(m[:, 4], 1e-9)
+        if self.arcs:
+            arc = np.array(self.arcs)
+            i = arc[:, 0].astype(np.int64)
+            u_in, u_out = u_in.copy(), u_out.copy()
+            d[i], u_in[i], u_out[i] = arc[:, 1], arc[:, 2:5], arc[:, 5:8]
+            v[i] = np.minimum(v[i], np.maximum(arc[:, 8], 1e-9))
+        # junction speed between move i-1 and i
+        cos_t = np.clip(-(u_out[:-1] * u_in[1:]).sum(1), -1.0, 1.0)
+        sin_h = np.sqrt(0.5 * (1.0 - cos_t))
+        with np.errstate(divide='ignore'):
+            vj = np.sqrt(a[1:] * self.jd * sin_h / np.maximum(1.0 - sin_h, 1e-12))
+        vj = np.minimum(vj, np.minimum(v[:-1], v[1:]))
+        n = len(d)
+        ve = np.append(vj, 0.0).tolist()   # exit speed of move i
+        vs = [0.0] + vj.tolist()           # entry speed of move i
+        dl, al = d.tolist(), a.tolist()
+        for i in range(n - 1, -1, -1):      # backward: must be able to slow down
+            cap = math.sqrt(ve[i] ** 2 + 2 * al[i] * dl[i])
+            if vs[i] > cap: vs[i] = cap
+            if i: ve[i-1] = min(ve[i-1], vs[i])
+        for i in range(n):                  # forward: must be able to speed up
+            cap = math.sqrt(vs[i] ** 2 + 2 * al[i] * dl[i])
+            if ve[i] > cap: ve[i] = cap
+            if i < n - 1: vs[i+1] = min(vs[i+1], ve[i])
+        vs, ve = np.array(vs), np.array(ve)
+        d_acc, d_dec = (v*v - vs*vs) / (2*a), (v*v - ve*ve) / (2*a)
+        cruise = d_acc + d_dec <= d
+        vp = np.where(cruise, v, np.sqrt(np.maximum((2*a*d + vs*vs + ve*ve) / 2, 0)))
+        t = (vp - vs) / a + (vp - ve) / a + np.where(cruise, (d - d_acc - d_dec) / v, 0.0)
+        for (key, layer), ti in zip(self.tags, t.tolist()):
+            self.total[key] += ti
+            self.total['time_s'] += ti
+            if layer is not None:
+                layer[key] += ti
+                layer['time_s'] += ti
+        self.moves, self.tags, self.arcs = [], [], []
+
+    def report(self):
+        self._flush()
+        r = lambda b: {k: round(v, 3) if isinstance(v, float) else v for k, v in b.items()}
+        return {**r(self.total), 'layers': {name: r(b) for name, b in self.layers.items()}}
+
+def fmt_duration(sec):
+    sec = int(round(sec))
+    return f"{sec // 3600}h {sec % 3600 // 60:02d}m {sec % 60:02d}s"
+
+def estimate_gcode(lines, cfg):
+    # lines: an iterable of G-code lines (or blocks of them), e.g. open('job.gcode')
+    est = TimeEstimator(cfg)
+    est.add_lines(line.rstrip("\n") for line in lines)
+    return est.report()
+
+def estimate_comments(report):
+    out = ["", f"; Estimated machine time: {fmt_duration(report['time_s'])}"
+               f"  (paint {fmt_duration(report['paint_s'])}, travel {fmt_duration(report['travel_s'])},"
+               f" z {fmt_duration(report['z_s'])}, dip {fmt_duration(report['dip_s'])})",
+           f"; Dips: {report['dips']}  Z lifts: {report['z_lifts']}"
+           f"  Paint: {report['paint_mm']:.0f} mm  Travel: {report['travel_mm']:.0f} mm"]
+    for name, b in report['layers'].items():
+        out.append(f";   {name}: {fmt_duration(b['time_s'])}, {b['dips']} dips, {b['paint_mm']:.0f} mm paint")
+    return out
+
+def with_estimate(lines, cfg, sink=None):
+    # Passes the program through and appends the estimate as trailing comments.
+    est = TimeEstimator(cfg)
+    for block in lines:
+        est.add_lines((block,))
+        yield block
+    report = est.report()
+    if sink is not None: sink(report)
+    yield from estimate_comments(report)
+
+
+# ─────────────────────────────────────────────
+# PREVIEW
+# ─────────────────────────────────────────────
+
+class ToolpathPreview:
+    # Replays a program into what the viewer draws, each item tagged with its layer:
+    # paint polylines (G1 XY moves at z_paint), travel moves (every other XY move) and
+    # dip locations. A dip runs from its marker to the first XY move that descends, the
+    # return from the dish; its first XY move is the dip location and nothing inside it
+    # is drawn. Level k of detail joins consecutive paint paths less than LOD_TOL[k]
+    # apart, simplifies them to that tolerance and drops shorter travel moves.
+    # G2/G3 arcs are drawn as chords within ARC_CHORD of the arc.
+    LOD_TOL = (0.0, 0.25, 1.0, 4.0, 16.0)  # mm
+    ARC_CHORD = 0.05  # mm
+    MAGIC = b'TPV1'
+
+    def __init__(self, cfg):
+        self.z_paint = float(cfg.get('z_paint', 0))
+        self.x = self.y = self.z = 0.0
+        self.layer = 0
+        self.in_dip = self.dip_pending = self.painting = False
+        self.xy, self.starts, self.path_layer = array('d'), [], []
+        self.travel, self.travel_layer = array('d'), []
+        self.dips, self.dip_layer = array('d'), []
+        self.built, self.levels = None, {}
+
+    def add_lines(self, lines):
+        for block in lines:
+            for line in block.split("\n") if "\n" in block else (block,):
+                self.add(line)
+
+    def add(self, line):
+        if not line or line[0] == ';':
+            if line.startswith('; LAYER '):
+                num = line[8:].partition(':')[0].strip()
+                if num.isdigit(): self.layer = int(num) - 1
+            elif 'CIKEL NAMAKANJA' in line:
+                self.in_dip = self.dip_pending = True
+                self.painting = False
+            return
+        words = line.split()
+        if not words or words[0] not in ('G0', 'G1', 'G2', 'G3'): return
+        x, y, z = self.x, self.y, self.z
+        ci = cj = 0.0
+        for w in words[1:]:
+            k = w[0]
+            if k == 'X': x = float(w[1:])
+            elif k == 'Y': y = float(w[1:])
+            elif k == 'Z': z = float(w[1:])
+            elif k == 'I': ci = float(w[1:])
+            elif k == 'J': cj = float(w[1:])
+        if x == self.x and y == self.y:
+            if z != self.z: self.painting = False
+        elif self.in_dip:
+            if self.dip_pending:
+                self.dips.extend((x, y))
+                self.dip_layer.append(self.layer)
+                self.dip_pending = False
+            elif z < self.z:
+                self.in_dip = False
+        elif words[0] != 'G0' and z == self.z and abs(z - self.z_paint) < 1e-6:
+            if not self.painting:
+                self.starts.append(len(self.xy) // 2)
+                self.xy.extend((self.x, self.y))
+                self.path_layer.append(self.layer)
+                self.painting = True
+            if words[0] != 'G1' and (ci or cj):
+                self.xy.extend(self._chords(x, y, self.x + ci, self.y + cj, 1 if words[0] == 'G3' else -1))
+            self.xy.extend((x, y))
+        else:
+            self.travel.extend((self.x, self.y, x, y))
+            self.travel_layer.append(self.layer)
+            self.painting = False
+        self.x, self.y, self.z = x, y, z
+
+    def _chords(self, x, y, cx, cy, turn):
+        # flattened x, y of the points strictly inside the arc from the current position
+        r, a0, swept = ArcFitter.sweep(self.x, self.y, x, y, cx, cy, turn)
+        step = 2 * math.acos(1 - self.ARC_CHORD / r) if r > self.ARC_CHORD else math.pi
+        n = math.ceil(swept / step)
+        out = []
+        for k in range(1, n):
+            a = a0 + turn * swept * k / n
+            out += (cx + r * math.cos(a), cy + r * math.sin(a))
+        return out
+
+    def build(self):
+        if self.built is None:
+            xy = np.frombuffer(self.xy, np.float64).reshape(-1, 2)
+            paths = PathSet(xy, np.array(self.starts + [len(xy)], np.int64))
+            travel = np.frombuffer(self.travel, np.float64).reshape(-1, 4)
+            dips = np.frombuffer(self.dips, np.float64).reshape(-1, 2)
+            every = np.concatenate((xy, travel.reshape(-1, 2), dips))
+            bounds = np.r_[every.min(0), every.max(0)] if len(every) else np.zeros(4)
+            self.built = (paths, np.array(self.path_layer, np.uint8), travel,
+                          np.array(self.travel_layer, np.uint8), dips, np.array(self.dip_layer, np.uint8), bounds)
+        return self.built
+
+    def geometry(self, k):
+        # (paths, layer ids, travel moves, layer ids) at level k, made from level k-1,
+        # so each pass only sees what the last one left
+        if k not in self.levels:
+            if k == 0:
+                paths, layer, travel, tlayer = self.build()[:4]
+            else:
+                paths, layer, travel, tlayer = self.geometry(k - 1)
+                tol = self.LOD_TOL[k]
+                if len(paths) > 1:
+                    ends = paths.endpoints()
+                    gap = np.hypot(*(ends[2::2] - ends[1:-1:2]).T)
+                    keep = np.r_[True, (gap >= tol) | (layer[1:] != layer[:-1]), True]
+                    paths, layer = PathSet(paths.xy, paths.offsets[keep]), layer[keep[:-1]]
+                paths = PathSimplifier.simplify(paths, tol)
+                far = np.hypot(travel[:, 2] - travel[:, 0], travel[:, 3] - travel[:, 1]) >= tol
+                travel, tlayer = travel[far], tlayer[far]
+            self.levels[k] = (paths, layer, travel, tlayer)
+        return self.levels[k]
+
+    def level(self, k):
+        # Little-endian buffer: 'TPV1', uint32 level, paths, vertices, travel moves, dips,
+        # float32 tolerance and bounds (x0, y0, x1, y1); then float32 vertices (x, y),
+        # uint32 path offsets (paths + 1), float32 travel moves (x0, y0, x1, y1), float32
+        # dips (x, y), and uint8 layer ids of paths, travel moves and dips.
+        paths, layer, travel, tlayer = self.geometry(k)
+        dips, dlayer, bounds = self.build()[4:]
+        head = np.array([k, len(paths), paths.n_points, len(travel), len(dips)], '<u4')
+        return b''.join([
+            self.MAGIC, head.tobytes(), np.r_[self.LOD_TOL[k], bounds].astype('<f4').tobytes(),
+            paths.xy.astype('<f4').tobytes(), paths.offsets.astype('<u4').tobytes(),
+            travel.astype('<f4').tobytes(), dips.astype('<f4').tobytes(),
+            layer.tobytes(), tlayer.tobytes(), dlayer.tobytes()])
+
+def preview_gcode(lines, cfg):
+    # lines: an iterable of G-code lines (or blocks of them), e.g. open('job.gcode')
+    preview = ToolpathPreview(cfg)
+    preview.add_lines(line.rstrip("\n") for line in lines)
+    return preview
+
+
+# ─────────────────────────────────────────────
+# COVERAGE
+# ─────────────────────────────────────────────
+
+class CoverageAnalyzer:
+    # Paints planned strokes onto the target mask's pixel grid at the real brush
+    # width and compares the result with the mask. Strokes are resampled every
+    # SPACING px and a disc of brush_w/2 is stamped at each sample, all in numpy, a
+    # chunk of whole strokes at a time. count holds the number of brush passes over
+    # each pixel: a pass starts where a stroke's disc reaches a pixel none of its
+    # last GAP samples covered, so a zig-zag row over its neighbour counts again,
+    # as the same rows painted as separate lines would.
+    SPACING = 0.5         # px between stamps
+    GAP = 4               # samples a pass may skip a pixel for, as the disc steps pixel to pixel
+    CHUNK = 1 << 22       # stamped pixels per chunk
+    # heat map: missed, canvas, 1, 2, 3, 4+ passes; spill (painted off target) is blended toward blue
+    COLORS = np.array([(230, 40, 40), (255, 255, 255), (120, 200, 120), (230, 210, 60),
+                       (240, 140, 40), (150, 50, 20)], np.uint8)
+
+    def __init__(self, mask, res, offset, brush_w):
+        self.target = mask.unpack() if isinstance(mask, BitMask) else mask
+        self.res, self.offset = res, np.asarray(offset, np.float64)
+        r = brush_w / 2 * res
+        k = int(math.floor(r))
+        dy, dx = np.mgrid[-k:k+1, -k:k+1]
+        disc = dx*dx + dy*dy <= r*r
+        self.disc = (dy[disc], dx[disc])
+        self.count = None
+
+    def _samples(self, paths, lo, hi):
+        # (x, y) px, stroke id and the stroke length each sample stands for, for
+        # strokes lo..hi in painting order: every point, then n more samples along
+        # the segment after it
+        o = paths.offsets
+        xy = (paths.xy[o[lo]:o[hi]] - self.offset) * self.res
+        stroke = np.repeat(np.arange(lo, hi), np.diff(o[lo:hi+1]))
+        seg = np.hypot(*np.diff(xy, axis=0).T)
+        seg[stroke[1:] != stroke[:-1]] = 0.0   # no segment between strokes
+        n = np.maximum(1, np.ceil(seg / self.SPACING).astype(np.int64))
+        n[seg == 0] = 0
+        per = np.append(n, 0) + 1
+        idx = np.repeat(np.arange(len(xy)), per)
+        start = np.zeros(len(per), np.int64)
+        np.cumsum(per[:-1], out=start[1:])
+        j = np.arange(len(idx)) - start[idx]
+        along = j > 0
+        t = j[along] / n[idx[along]]
+        pts = xy[idx]
+        pts[along] += (xy[idx[along] + 1] - xy[idx[along]]) * t[:, None]
+        weight = np.zeros(len(idx))
+        weight[along] = (seg / np.maximum(n, 1))[idx[along]] / self.res
+        return pts, stroke[idx], weight
+
+    def _stamp(self, pts):
+        # flat pixel index of every disc pixel around every sample, -1 off the canvas
+        h, w = self.target.shape
+        cy = np.rint(pts[:, 1]).astype(np.int64)[:, None] + self.disc[0]
+        cx = np.rint(pts[:, 0]).astype(np.int64)[:, None] + self.disc[1]
+        return np.where((cx >= 0) & (cx < w) & (cy >= 0) & (cy < h), cy * w + cx, -1)
+
+    def _chunks(self, paths):
+        # stroke ranges of about CHUNK stamped pixels
+        per = max(1, self.CHUNK // len(self.disc[0]))
+        ends = np.cumsum(paths.lengths + paths.path_lengths() * self.res / self.SPACING)
+        lo = 0
+        while lo < len(paths):
+            hi = max(lo + 1, int(np.searchsorted(ends, (ends[lo - 1] if lo else 0.0) + per, 'right')))
+            yield lo, hi
+            lo = hi
+
+    def _passes(self, ids, pix):
+        # pixel of every pass start: a stamped pixel, unless one of the GAP samples
+        # before it on the same stroke covered it too
+        size = self.target.size
+        k = np.repeat(np.arange(len(ids)), pix.shape[1])
+        pix = pix.ravel()
+        on = pix >= 0
+        k, pix = k[on], pix[on]
+        key = k * size + pix
+        seen = np.unique(key)
+        start = np.ones(len(key), bool)
+        for g in range(1, self.GAP + 1):
+            prev = key - g * size
+            found = seen[np.minimum(np.searchsorted(seen, prev), len(seen) - 1)] == prev
+            start &= ~(found & (k >= g) & (ids[np.maximum(k - g, 0)] == ids[k]))
+        return pix[start]
+
+    def analyze(self, paths):
+        target = self.target.ravel()
+        count = np.zeros(target.size, np.int32)
+        for lo, hi in self._chunks(paths):
+            pts, ids, _ = self._samples(paths, lo, hi)
+            np.add.at(count, self._passes(ids, self._stamp(pts)), 1)
+        # a sample is wasted when no target pixel under it is painted by its pass alone
+        sole = target & (count == 1)
+        total = wasted = 0.0
+        for lo, hi in self._chunks(paths):
+            pts, _, weight = self._samples(paths, lo, hi)
+            pix = self._stamp(pts)
+            useful = np.where(pix >= 0, sole[np.maximum(pix, 0)], False).any(1)
+            total += weight.sum()
+            wasted += weight[~useful].sum()
+        self.count = count.reshape(self.target.shape)
+        px = 1.0 / self.res ** 2
+        painted = count > 0
+        n_target, n_painted = int(target.sum()), int(painted.sum())
+        return {'strokes': len(paths), 'target_mm2': round(n_target * px, 1),
+                'coverage_pct': round(100.0 * int((painted & target).sum()) / max(1, n_target), 2),
+                'missed_mm2': round(int((target & ~painted).sum()) * px, 1),
+                'spill_mm2': round(int((painted & ~target).sum()) * px, 1),
+                'overpaint': round(int(count.sum()) / max(1, n_painted), 3),
+                'stroke_mm': round(float(total), 1), 'wasted_mm': round(float(wasted), 1),
+                'wasted_pct': round(100.0 * float(wasted / total), 2) if total else 0.0}
+
+    def heatmap(self):
+        # RGB image of the last analysis, top row up like the source image
+        level = np.minimum(self.count, 4) + 1
+        level[(self.count == 0) & self.target] = 0
+        rgb = self.COLORS[level]
+        spill = (self.count > 0) & ~self.target
+        rgb[spill] = (rgb[spill] // 2 + np.array((40, 80, 127), np.uint8))
+        return Image.fromarray(rgb[::-1])
+
+def analyze_layer(cfg, img_path, heatmap=None):
+    # Coverage of one layer's planned strokes, simplified as they are emitted;
+    # heatmap: a path or file object to save the heat-map PNG to.
+    painter = UltraPainter(cfg)
+    mask = painter.load_mask(img_path)
+    paths = PathSimplifier.simplify(painter.generate_paths(img_path), cfg.get('simplify_tol', 0))
+    analyzer = CoverageAnalyzer(mask, painter.res, (cfg['x_off'], cfg['y_off']), cfg['brush_w'])
+    report = analyzer.analyze(paths)
+    if heatmap is not None: analyzer.heatmap().save(heatmap, format='PNG')
+    return report
+
+
+# ─────────────────────────────────────────────
+# CACHE
+# ─────────────────────────────────────────────
+
+MASK_KEYS = ('target_width', 'res')
+PATH_KEYS = MASK_KEYS + ('brush_w', 'overlap', 'infill_type', 'infill_angle', 'x_off', 'y_off',
+                         'concentric_metric', 'tile', 'dip_x', 'dip_y', 'opt_refine_time', 'region_order')
+
+@functools.lru_cache(maxsize=256)
+def _file_digest(img_path, mtime_ns, size):
+    with open(img_path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def image_digest(img_path):
+    st = os.stat(img_path)
+    return _file_digest(img_path, st.st_mtime_ns, st.st_size)
+
+class PlanCache:
+    # Content-addressed store for binarized masks and ordered path sets. Entries sit
+    # in a per-process LRU and in .npz files on disk, which pool workers share; both
+    # are size-bounded and evict least recently used first (file mtime on disk).
+    # VERSION is part of every key: bump it whenever planning changes what an entry
+    # holds, so entries from an older planner are never reused.
+    VERSION = 2
+
+    def __init__(self, folder, max_bytes=1 << 30, mem_bytes=256 << 20):
+        self.folder, self.max_bytes, self.mem_bytes = folder, max_bytes, mem_bytes
+        self.mem, self.mem_used = OrderedDict(), 0
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def key(kind, *parts):
+        return kind + '-' + hashlib.sha1(json.dumps([PlanCache.VERSION, *parts], default=str).encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.mem:
+                self.mem.move_to_end(key)
+                return self.mem[key]
+        path = os.path.join(self.folder, key + '.npz')
+        try:
+            with np.load(path) as z:
+                entry = {k: z[k] for k in z.files}
+            os.utime(path)
+        except OSError:
+            return None
+        except (ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            # corrupt or truncated: a miss, and the entry is replanned and rewritten
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        self._remember(key, entry)
+        tmp = os.path.join(self.folder, f'{key}.{os.getpid()}.{threading.get_ident()}.tmp.npz')
+        try:
+            np.savez(tmp, **entry)
+            os.replace(tmp, os.path.join(self.folder, key + '.npz'))
+        except OSError:
+            return
+        self._evict_disk()
+
+    def _remember(self, key, entry):
+        size = sum(a.nbytes for a in entry.values())
+        if size > self.mem_bytes: return
+        with self.lock:
+            if key in self.mem:
+                self.mem_used -= sum(a.nbytes for a in self.mem.pop(key).values())
+            self.mem[key] = entry
+            self.mem_used += size
+            while self.mem_used > self.mem_bytes:
+                _, old = self.mem.popitem(last=False)
+                self.mem_used -= sum(a.nbytes for a in old.values())
+
+    def _evict_disk(self):
+        files = []
+        for e in os.scandir(self.folder):
+            if e.name.endswith('.npz') and '.tmp.' not in e.name:
+                st = e.stat()
+                files.append((st.st_mtime, st.st_size, e.path))
+        total = sum(f[1] for f in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes: break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+PLAN_CACHE = PlanCache('/tmp/painter_cache')
+
+
+# ─────────────────────────────────────────────
+# METRICS
+# ─────────────────────────────────────────────
+
+PROFILE_FOLDER = '/tmp/painter_profiles'
+os.makedirs(PROFILE_FOLDER, exist_ok=True)
+
+class Metrics:
+    # Process-wide counters and stage timings, rendered in Prometheus text format.
+    STAGES = ('decode', 'threshold', 'resize', 'infill', 'optimize', 'simplify', 'arcfit', 'emit')
+    COUNTERS = ('paths', 'points', 'dips', 'splits', 'arcs', 'gcode_lines')
+    BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stage_sum = dict.fromkeys(self.STAGES, 0.0)
+        self.stage_count = dict.fromkeys(self.STAGES, 0)
+        self.totals = dict.fromkeys(self.COUNTERS, 0)
+        self.layers, self.cache_hits = 0, 0
+        self.layer_buckets = [0] * len(self.BUCKETS)
+        self.layer_sum = 0.0
+        self.labelled = {}
+
+    def inc(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.labelled[key] = self.labelled.get(key, 0) + 1
+
+    def record_layer(self, stats):
+        with self.lock:
+            self.layers += 1
+            self.cache_hits += bool(stats.get('cache_hit'))
+            total = 0.0
+            for st in self.STAGES:
+                if st + '_s' in stats:
+                    self.stage_sum[st] += stats[st + '_s']
+                    self.stage_count[st] += 1
+                    total += stats[st + '_s']
+            for k in self.COUNTERS:
+                self.totals[k] += stats.get(k, 0)
+            self.layer_sum += total
+            for n, le in enumerate(self.BUCKETS):
+                if total <= le: self.layer_buckets[n] += 1
+
+    def render(self):
+        with self.lock:
+            out = ["# HELP painter_stage_seconds Time spent in each planning stage.",
+                   "# TYPE painter_stage_seconds summary"]
+            for st in self.STAGES:
+                out.append(f'painter_stage_seconds_sum{{stage="{st}"}} {self.stage_sum[st]:.6f}')
+                out.append(f'painter_stage_seconds_count{{stage="{st}"}} {self.stage_count[st]}')
+            out += ["# HELP painter_layer_seconds Planning and emission time per layer.",
+                    "# TYPE painter_layer_seconds histogram"]
+            for le, n in zip(self.BUCKETS, self.layer_buckets):
+                out.append(f'painter_layer_seconds_bucket{{le="{le}"}} {n}')
+            out += [f'painter_layer_seconds_bucket{{le="+Inf"}} {self.layers}',
+                    f'painter_layer_seconds_sum {self.layer_sum:.6f}',
+                    f'painter_layer_seconds_count {self.layers}']
+            for k in self.COUNTERS:
+                out += [f"# TYPE painter_{k}_total counter", f"painter_{k}_total {self.totals[k]}"]
+            out += ["# TYPE painter_layers_total counter", f"painter_layers_total {self.layers}",
+                    "# TYPE painter_cache_hits_total counter", f"painter_cache_hits_total {self.cache_hits}"]
+            for name in sorted({k[0] for k in self.labelled}):
+                out.append(f"# TYPE painter_{name}_total counter")
+                for (n, labels), v in sorted(self.labelled.items()):
+                    if n != name: continue
+                    lbl = ','.join(f'{k}="{val}"' for k, val in labels)
+                    out.append(f"painter_{name}_total{{{lbl}}} {v}")
+            return "\n".join(out) + "\n"
+
+METRICS = Metrics()
 
 
 # ─────────────────────────────────────────────
@@ -158,12 +1949,34 @@ class UltraPainter:
 UPLOAD_FOLDER = '/tmp/painter_uploads'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-@app.route('/')
+ROUTES = []
+
+def route(rule, **options):
+    # Collects views for create_app(), so importing this module doesn't need Flask.
+    def register(view):
+        ROUTES.append((rule, view, options))
+        return view
+    return register
+
+def create_app():
+    from flask import Flask
+    app = Flask(__name__)
+    for rule, view, options in ROUTES:
+        app.add_url_rule(rule, view_func=view, **options)
+    return app
+
+@route('/')
 def index():
-    return render_template_string(HTML_TEMPLATE)
+    from flask import render_template_string
+    return render_template_string(HTML_TEMPLATE, lod_tol=list(ToolpathPreview.LOD_TOL))
+
+PREVIEW_MAX = 640  # px, longer side of the preview thumbnail
 
-@app.route('/upload_preview', methods=['POST'])
+@route('/upload_preview', methods=['POST'])
 def upload_preview():
+    # Binarizes once at full resolution and caches the bit-packed mask for generation.
+    # The preview is a thumbnail, inline as base64 or, with inline=0, a /preview URL.
+    from flask import request, jsonify
     f = request.files.get('image')
     layer = request.form.get('layer', '0')
     if not f:
@@ -171,61 +1984,472 @@ def upload_preview():
     path = os.path.join(UPLOAD_FOLDER, f'layer_{layer}_{f.filename}')
     f.save(path)
     img = Image.open(path).convert('L')
-    img_bin = img.point(lambda p: 0 if p < 140 else 255)
-    buf = io.BytesIO()
-    img_bin.save(buf, format='PNG')
-    b64 = base64.b64encode(buf.getvalue()).decode()
-    arr = np.array(img_bin) < 140
-    coverage = float(arr.sum()) / arr.size * 100
+    arr = UltraPainter.binarize(img)
+    digest = image_digest(path)
+    PLAN_CACHE.put(PLAN_CACHE.key('bitmask', digest), BitMask.pack(arr).entry())
+    thumb_path = os.path.join(UPLOAD_FOLDER, digest + '.preview.png')
+    if not os.path.exists(thumb_path):
+        thumb = Image.fromarray(np.where(arr, 0, 255).astype(np.uint8))
+        thumb.thumbnail((PREVIEW_MAX, PREVIEW_MAX), Image.Resampling.BOX)
+        thumb.save(thumb_path + '.tmp', format='PNG')
+        os.replace(thumb_path + '.tmp', thumb_path)
+    if request.values.get('inline', '1') == '0':
+        preview = f'/preview/{digest}.png'
+    else:
+        with open(thumb_path, 'rb') as t:
+            preview = 'data:image/png;base64,' + base64.b64encode(t.read()).decode()
     return jsonify({
         'path': path,
-        'preview': f'data:image/png;base64,{b64}',
-        'coverage': round(coverage, 1),
+        'preview': preview,
+        'coverage': round(float(arr.mean()) * 100, 1),
         'size': [img.width, img.height]
     })
 
-@app.route('/generate', methods=['POST'])
-def generate():
-    data = request.json
-    global_cfg = data['global']
-    layers = data['layers']
+@route('/preview/<digest>.png')
+def preview_image(digest):
+    from flask import jsonify, send_file
+    path = os.path.join(UPLOAD_FOLDER, digest + '.preview.png')
+    if not all(ch in '0123456789abcdef' for ch in digest) or not os.path.exists(path):
+        return jsonify({'error': 'unknown preview'}), 404
+    return send_file(path, mimetype='image/png', max_age=86400)
+
+def layer_cfg(global_cfg, layer):
+    return {
+        **global_cfg,
+        'dip_x':        float(layer['dip_x']),
+        'dip_y':        float(layer['dip_y']),
+        'infill_type':  layer.get('infill_type', 'lines'),
+        'infill_angle': float(layer.get('infill_angle', 0)),
+        'brush_w':      float(layer['brush_w']) if layer.get('brush_w') is not None else global_cfg['brush_w'],
+    }
 
-    combined = [
+def with_seed(global_cfg):
+    if global_cfg.get('seed') is None:
+        return {**global_cfg, 'seed': random.randrange(1 << 31)}
+    return global_cfg
+
+def plan_layer(cfg, img_path, out_path, progress=None, profile_path=None):
+    # Writes the layer's lines to out_path, "\n"-joined, so a pool worker hands back a
+    # file rather than the whole layer and the parent streams it from disk.
+    painter = UltraPainter(cfg, progress)
+    prof = cProfile.Profile() if profile_path else None
+    if prof: prof.enable()
+    with open(out_path, 'w') as f:
+        sep = ""
+        for line in painter.generate(img_path, header=False):
+            f.write(sep)
+            f.write(line)
+            sep = "\n"
+    if prof:
+        prof.disable()
+        prof.dump_stats(profile_path)
+        painter.stats['profile'] = profile_path
+    return painter.stats
+
+def layer_blocks(path, size=1 << 16):
+    # Reads back a plan_layer file as blocks of whole lines, the same text once joined with "\n".
+    rest, split = "", False
+    with open(path) as f:
+        for data in iter(lambda: f.read(size), ""):
+            head, nl, tail = (rest + data).rpartition("\n")
+            if nl:
+                yield head
+                rest, split = tail, True
+            else:
+                rest = tail
+    if rest or split: yield rest
+
+def layer_file():
+    fd, path = tempfile.mkstemp(prefix='layer', suffix='.gcode')
+    os.close(fd)
+    return path
+
+def discard_file(path):
+    if os.path.exists(path): os.remove(path)
+
+_layer_pools = {}
+
+def layer_pool(workers):
+    if workers not in _layer_pools:
+        _layer_pools[workers] = ProcessPoolExecutor(max_workers=workers)
+    return _layer_pools[workers]
+
+def layer_workers(global_cfg, layers):
+    workers = int(global_cfg.get('workers') or os.cpu_count() or 1)
+    return workers if len(layers) > 1 else 1
+
+def program_lines(global_cfg, layers, progress=None, stats=None, profile=None):
+    # Layers are planned in parallel and stitched back in order. Each one gets its
+    # own seed (global seed + layer index), so dips repeat for a given seed.
+    # progress(i), when given, returns the progress sink for layer i; stats(i, d)
+    # receives each layer's timings and counters; profile names a cProfile dump prefix.
+    # Pool workers plan into temp files, at most one layer per worker ahead of the one
+    # being streamed, so memory stays bounded however many layers there are.
+    global_cfg = with_seed(global_cfg)
+    cfgs = [{**layer_cfg(global_cfg, layer), 'seed': int(global_cfg['seed']) + i} for i, layer in layers]
+    workers = layer_workers(global_cfg, layers)
+    prof = lambda i: profile and f"{profile}_layer{i+1}.prof"
+    jobs = {}
+    if workers > 1:
+        cfgs = [{**cfg, 'infill_workers': 1} for cfg in cfgs]  # the layers already fill the pool
+        pool = layer_pool(workers)
+
+    def submit(n):
+        if n < len(layers) and workers > 1:
+            i, layer = layers[n]
+            path = layer_file()
+            jobs[n] = path, pool.submit(plan_layer, cfgs[n], layer['image_path'], path, progress and progress(i), prof(i))
+
+    for n in range(workers):
+        submit(n)
+    yield from [
         "G90", "G21",
         "; === MULTI-COLOR PAINTER GCODE ===",
-        f"; Layers: {sum(1 for l in layers if l.get('enabled') and l.get('image_path'))}\n"
+        f"; Seed: {global_cfg['seed']}",
+        f"; Layers: {len(layers)}\n"
     ]
-
-    for i, layer in enumerate(layers):
-        if not layer.get('enabled') or not layer.get('image_path'):
-            continue
+    try:
+        for n, (i, layer) in enumerate(layers):
+            yield from [
+                f"\n; ═══════════════════════════════════",
+                f"; LAYER {i+1}: {layer.get('name','Color '+str(i+1))}",
+                f"; ═══════════════════════════════════\n"
+            ]
+            if workers > 1:
+                path, job = jobs[n]
+                layer_stats = job.result()
+                submit(n + workers)
+            elif profile:
+                path = layer_file()
+                jobs[n] = path, None
+                layer_stats = plan_layer(cfgs[n], layer['image_path'], path, progress and progress(i), prof(i))
+            else:
+                painter = UltraPainter(cfgs[n], progress and progress(i))
+                yield from painter.generate(layer['image_path'], header=False)
+                layer_stats = painter.stats
+            if n in jobs:
+                yield from layer_blocks(path)
+                discard_file(jobs.pop(n)[0])
+            if stats: stats(i, layer_stats)
+    finally:
+        for path, job in jobs.values():
+            if job is None or job.cancel() or job.done(): discard_file(path)
+            else: job.add_done_callback(lambda _, path=path: discard_file(path))
+    yield from ["", "M400", f"G0 Z{global_cfg['z_high']:.3f} F3000", "M2"]
+
+def iter_chunks(lines, size=1 << 16, compress=False):
+    # Same bytes as "\n".join(lines), cut into ~size chunks and optionally gzipped.
+    z = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buf, n, first = [], 0, True
+    for line in lines:
+        buf.append(line)
+        n += len(line) + 1
+        if n >= size:
+            chunk = ("\n".join(buf) if first else "\n" + "\n".join(buf)).encode()
+            buf, n, first = [], 0, False
+            chunk = z.compress(chunk) if z else chunk
+            if chunk: yield chunk
+    chunk = ("\n".join(buf) if first else "\n" + "\n".join(buf)).encode() if buf else b""
+    if z: chunk = z.compress(chunk) + z.flush()
+    if chunk: yield chunk
+
+def active_layers(data):
+    layers = [(i, l) for i, l in enumerate(data['layers']) if l.get('enabled') and l.get('image_path')]
+    for key in ('min_dist', 'max_dist'):
+        value = data.get('global', {}).get(key, 1)
+        if not (isinstance(value, (int, float)) and value > 0):
+            return layers, f"{key.replace('_', ' ').capitalize()} must be a positive distance in mm."
+    for i, layer in layers:
         if not os.path.exists(layer['image_path']):
-            return jsonify({'error': f"Image for layer {i+1} not found on server. Re-upload."}), 400
-
-        combined += [
-            f"\n; ═══════════════════════════════════",
-            f"; LAYER {i+1}: {layer.get('name','Color '+str(i+1))}",
-            f"; ═══════════════════════════════════\n"
-        ]
-
-        cfg = {
-            **global_cfg,
-            'dip_x':        float(layer['dip_x']),
-            'dip_y':        float(layer['dip_y']),
-            'infill_type':  layer.get('infill_type', 'lines'),
-            'infill_angle': float(layer.get('infill_angle', 0)),
-            'brush_w':      float(layer['brush_w']) if layer.get('brush_w') is not None else global_cfg['brush_w'],
-        }
+            return layers, f"Image for layer {i+1} not found on server. Re-upload."
+    return layers, None
+
+@route('/generate', methods=['POST'])
+def generate():
+    from flask import Response, request, jsonify
+    data = request.json
+    global_cfg = with_seed(data['global'])
+    layers, error = active_layers(data)
+    if error:
+        return jsonify({'error': error}), 400
+
+    compress = request.args.get('gzip') == '1'
+    profile = request.args.get('profile') == '1' and os.path.join(PROFILE_FOLDER, uuid.uuid4().hex[:12])
+    headers = {'Content-Disposition': 'attachment; filename=multicolor_paint.gcode', 'X-Painter-Seed': str(global_cfg['seed'])}
+    if compress: headers['Content-Encoding'] = 'gzip'
+    if profile: headers['X-Painter-Profile'] = profile + '_layer*.prof'
+    METRICS.inc('requests', endpoint='generate')
+    lines = program_lines(global_cfg, layers, stats=lambda i, st: METRICS.record_layer(st), profile=profile)
+    lines = with_estimate(lines, global_cfg)
+    return Response(iter_chunks(lines, compress=compress), mimetype='text/plain', headers=headers)
+
+@route('/metrics')
+def metrics():
+    from flask import Response
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+@route('/estimate', methods=['POST'])
+def estimate():
+    from flask import request, jsonify
+    f = request.files.get('gcode')
+    if not f:
+        return jsonify({'error': 'no file'}), 400
+    cfg = json.loads(request.form.get('global', '{}'))
+    return jsonify(estimate_gcode(io.TextIOWrapper(f.stream, encoding='utf-8'), cfg))
+
+def lod_arg(request):
+    lod = request.values.get('lod', '0')
+    return int(lod) if lod.isdigit() and int(lod) < len(ToolpathPreview.LOD_TOL) else None
+
+def toolpath_response(body):
+    from flask import Response
+    return Response(body, mimetype='application/octet-stream',
+                    headers={'X-Toolpath-Levels': ','.join(map(str, ToolpathPreview.LOD_TOL))})
+
+@route('/toolpath', methods=['POST'])
+def toolpath():
+    # Binary toolpath preview of an uploaded program; see ToolpathPreview.level for the layout.
+    from flask import request, jsonify
+    f, lod = request.files.get('gcode'), lod_arg(request)
+    if not f:
+        return jsonify({'error': 'no file'}), 400
+    if lod is None:
+        return jsonify({'error': f'lod must be 0-{len(ToolpathPreview.LOD_TOL) - 1}'}), 400
+    cfg = json.loads(request.form.get('global', '{}'))
+    return toolpath_response(preview_gcode(io.TextIOWrapper(f.stream, encoding='utf-8'), cfg).level(lod))
+
+@route('/analyze', methods=['POST'])
+def analyze():
+    # Coverage report per layer for a /generate body; ?heatmap=1 adds each heat map as a PNG data URL.
+    from flask import request, jsonify
+    data = request.json
+    global_cfg = with_seed(data['global'])
+    layers, error = active_layers(data)
+    if error:
+        return jsonify({'error': error}), 400
+    METRICS.inc('requests', endpoint='analyze')
+    out = {}
+    for i, layer in layers:
+        buf = io.BytesIO() if request.args.get('heatmap') == '1' else None
+        out[i] = analyze_layer(layer_cfg(global_cfg, layer), layer['image_path'], buf)
+        if buf: out[i]['heatmap'] = 'data:image/png;base64,' + base64.b64encode(buf.getvalue()).decode()
+    return jsonify({'layers': out})
 
-        painter = UltraPainter(cfg)
-        painter.current_pos = (cfg['dip_x'], cfg['dip_y'])
-        painter.generate(layer['image_path'], append_to=combined)
 
-    combined += ["", "M400", f"G0 Z{global_cfg['z_high']:.3f} F3000", "M2"]
+# ─────────────────────────────────────────────
+# JOBS
+# ─────────────────────────────────────────────
 
-    buf = io.BytesIO("\n".join(combined).encode())
-    buf.seek(0)
-    return send_file(buf, mimetype='text/plain', as_attachment=True, download_name='multicolor_paint.gcode')
+JOB_FOLDER = '/tmp/painter_jobs'
+os.makedirs(JOB_FOLDER, exist_ok=True)
+JOB_WORKERS = 2
+MAX_JOBS = 50
+# share of a layer's progress bar taken by each stage: (offset, weight)
+JOB_STAGES = {'queued': (0.0, 0.0), 'load': (0.0, 0.05), 'infill': (0.05, 0.35),
+              'optimize': (0.4, 0.3), 'emit': (0.7, 0.3)}
+
+class JobCancelled(Exception):
+    pass
+
+class Progress:
+    # Picklable per-layer progress sink: forwards (layer, stage, frac) to a queue at
+    # most once per percent and raises JobCancelled once the cancel event is set.
+    def __init__(self, layer, queue, cancel):
+        self.layer, self.queue, self.cancel = layer, queue, cancel
+        self.stage, self.last = None, -1.0
+
+    def __call__(self, stage, frac):
+        if self.cancel.is_set(): raise JobCancelled()
+        if stage != self.stage or frac - self.last >= 0.01 or frac >= 1.0:
+            self.stage, self.last = stage, frac
+            self.queue.put((self.layer, stage, frac))
+
+_manager = None
+
+def job_manager():
+    # queue/event proxies that pool workers can report through
+    global _manager
+    if _manager is None:
+        _manager = multiprocessing.Manager()
+    return _manager
+
+class Job:
+    def __init__(self, global_cfg, layers):
+        self.id = uuid.uuid4().hex[:12]
+        self.global_cfg, self.layers = with_seed(global_cfg), layers
+        self.state, self.error = 'queued', None
+        self.layer_progress = {i: ('queued', 0.0) for i, _ in layers}
+        self.path = os.path.join(JOB_FOLDER, self.id + '.gcode')
+        self.created = time.time()
+        self.changed = threading.Condition()
+        self.version = 0
+        self.future = self.cancel_event = None
+        self.cancelled = False
+        self.estimate = None
+        self.stats = {}
+        self.preview, self.preview_lock = None, threading.Lock()
+
+    def status(self):
+        with self.changed:
+            layers = {i: {'stage': st, 'progress': round(fr, 3)} for i, (st, fr) in self.layer_progress.items()}
+            done = [JOB_STAGES[st][0] + JOB_STAGES[st][1] * fr for st, fr in self.layer_progress.values()]
+            total = 1.0 if self.state == 'done' else sum(done) / max(1, len(done))
+            return {'id': self.id, 'state': self.state, 'progress': round(total, 3), 'layers': layers,
+                    'seed': self.global_cfg['seed'], 'error': self.error, 'estimate': self.estimate,
+                    'stats': self.stats}
+
+    def _set(self, state=None, layer=None, stage=None, frac=None):
+        with self.changed:
+            if state: self.state = state
+            if layer is not None: self.layer_progress[layer] = (stage, frac)
+            self.version += 1
+            self.changed.notify_all()
+
+    def _record_stats(self, i, stats):
+        METRICS.record_layer(stats)
+        with self.changed:
+            self.stats[i] = {k: round(v, 4) if isinstance(v, float) else v for k, v in stats.items()}
+
+    def _pump(self, q):
+        for msg in iter(q.get, None):
+            self._set(layer=msg[0], stage=msg[1], frac=msg[2])
+
+    def run(self):
+        if self.cancelled: return
+        if layer_workers(self.global_cfg, self.layers) > 1:
+            mgr = job_manager()
+            q, self.cancel_event = mgr.Queue(), mgr.Event()
+        else:
+            q, self.cancel_event = queue.Queue(), threading.Event()
+        if self.cancelled: self.cancel_event.set()
+        self._set(state='running')
+        pump = threading.Thread(target=self._pump, args=(q,), daemon=True)
+        pump.start()
+        tmp = self.path + '.part'
+        try:
+            with open(tmp, 'wb') as f:
+                profile = self.global_cfg.get('profile') and os.path.join(PROFILE_FOLDER, self.id)
+                lines = program_lines(self.global_cfg, self.layers, lambda i: Progress(i, q, self.cancel_event),
+                                      self._record_stats, profile)
+                lines = with_estimate(lines, self.global_cfg, lambda report: setattr(self, 'estimate', report))
+                for chunk in iter_chunks(lines):
+                    if self.cancel_event.is_set(): raise JobCancelled()
+                    f.write(chunk)
+            os.replace(tmp, self.path)
+            state = 'done'
+        except JobCancelled:
+            state = 'cancelled'
+        except Exception as e:
+            state, self.error = 'failed', str(e)
+        finally:
+            q.put(None)
+            pump.join()
+            if os.path.exists(tmp): os.remove(tmp)
+        self._set(state=state)
+        METRICS.inc('jobs', state=state)
+
+    def toolpath(self, lod):
+        # parsed from the finished program on first use; levels are built as asked for
+        with self.preview_lock:
+            if self.preview is None:
+                with open(self.path) as f:
+                    self.preview = preview_gcode(f, self.global_cfg)
+            return self.preview.level(lod)
+
+    def cancel(self):
+        self.cancelled = True
+        if self.future is not None and self.future.cancel():
+            self._set(state='cancelled')
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+
+JOBS = OrderedDict()
+JOBS_LOCK = threading.Lock()  # request threads add, evict and look up jobs concurrently
+JOB_POOL = ThreadPoolExecutor(max_workers=JOB_WORKERS)
+
+def submit_job(global_cfg, layers):
+    job = Job(global_cfg, layers)
+    with JOBS_LOCK:
+        JOBS[job.id] = job
+        finished = [j for j in JOBS.values() if j.state in ('done', 'failed', 'cancelled')]
+        evicted = finished[:max(0, len(JOBS) - MAX_JOBS)]
+        for old in evicted:
+            del JOBS[old.id]
+    for old in evicted:
+        if os.path.exists(old.path): os.remove(old.path)
+    job.future = JOB_POOL.submit(job.run)
+    return job
+
+def get_job(job_id):
+    with JOBS_LOCK:
+        return JOBS.get(job_id)
+
+@route('/jobs', methods=['POST'])
+def create_job():
+    from flask import request, jsonify
+    data = request.json
+    layers, error = active_layers(data)
+    if error:
+        return jsonify({'error': error}), 400
+    job = submit_job(data['global'], layers)
+    METRICS.inc('requests', endpoint='jobs')
+    return jsonify(job.status()), 202
+
+@route('/jobs/<job_id>')
+def job_status(job_id):
+    from flask import jsonify
+    job = get_job(job_id)
+    if not job:
+        return jsonify({'error': 'unknown job'}), 404
+    return jsonify(job.status())
+
+@route('/jobs/<job_id>/events')
+def job_events(job_id):
+    from flask import Response, jsonify
+    job = get_job(job_id)
+    if not job:
+        return jsonify({'error': 'unknown job'}), 404
+    def stream():
+        seen = -1
+        while True:
+            with job.changed:
+                job.changed.wait_for(lambda: job.version != seen, timeout=15)
+                seen = job.version
+            status = job.status()
+            yield f"data: {json.dumps(status)}\n\n"
+            if status['state'] in ('done', 'failed', 'cancelled'): return
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    from flask import jsonify
+    job = get_job(job_id)
+    if not job:
+        return jsonify({'error': 'unknown job'}), 404
+    job.cancel()
+    return jsonify(job.status())
+
+@route('/jobs/<job_id>/result')
+def job_result(job_id):
+    from flask import jsonify, send_file
+    job = get_job(job_id)
+    if not job:
+        return jsonify({'error': 'unknown job'}), 404
+    if job.state != 'done':
+        return jsonify({'error': f'job is {job.state}'}), 409
+    return send_file(job.path, mimetype='text/plain', as_attachment=True, download_name='multicolor_paint.gcode')
+
+@route('/jobs/<job_id>/toolpath')
+def job_toolpath(job_id):
+    from flask import request, jsonify
+    job, lod = get_job(job_id), lod_arg(request)
+    if not job:
+        return jsonify({'error': 'unknown job'}), 404
+    if job.state != 'done':
+        return jsonify({'error': f'job is {job.state}'}), 409
+    if lod is None:
+        return jsonify({'error': f'lod must be 0-{len(ToolpathPreview.LOD_TOL) - 1}'}), 400
+    return toolpath_response(job.toolpath(lod))
 
 
 # ─────────────────────────────────────────────
@@ -364,12 +2588,39 @@ header{
 .btn-gen:hover{transform:translateY(-1px);box-shadow:0 4px 18px rgba(232,255,71,.32)}
 .btn-gen:active{transform:translateY(0)}
 .btn-gen:disabled{opacity:.35;cursor:not-allowed;transform:none;box-shadow:none}
+.btn-cancel{
+  display:none;font-family:var(--sans);font-weight:600;font-size:.8rem;
+  letter-spacing:.18em;text-transform:uppercase;background:transparent;color:var(--accent2);
+  border:1px solid var(--accent2);padding:10px 16px;border-radius:3px;cursor:pointer;
+}
+.btn-cancel.vis{display:block}
 .st{font-family:var(--sans);font-size:.78rem;color:var(--muted);letter-spacing:.04em}
 .st.err{color:var(--accent2)}.st.ok{color:var(--accent)}
 .pw{display:none;flex:1;align-items:center;gap:10px}
 .pw.vis{display:flex}
 .pb{flex:1;height:2px;background:var(--border);border-radius:1px;overflow:hidden}
 .pf{height:100%;background:var(--accent);width:0%;transition:width .3s}
+.btn-view{
+  display:none;font-family:var(--sans);font-weight:600;font-size:.8rem;
+  letter-spacing:.18em;text-transform:uppercase;background:transparent;color:var(--accent);
+  border:1px solid var(--accent);padding:10px 16px;border-radius:3px;cursor:pointer;white-space:nowrap;
+}
+.btn-view.vis{display:block}
+
+.viewer{display:none;position:fixed;inset:0;background:var(--bg);z-index:50}
+.viewer.vis{display:block}
+.viewer canvas{width:100%;height:100%;display:block;cursor:grab}
+.v-bar{
+  position:absolute;top:0;left:0;right:0;display:flex;align-items:center;gap:18px;
+  padding:10px 16px;background:rgba(19,21,27,.85);border-bottom:1px solid var(--border);
+  font-family:var(--sans);font-size:.78rem;letter-spacing:.08em;color:var(--text);
+}
+.v-bar label{display:flex;align-items:center;gap:6px;cursor:pointer}
+.v-info{flex:1;color:var(--muted)}
+.v-bar button{
+  font-family:var(--sans);font-weight:600;font-size:.75rem;letter-spacing:.18em;text-transform:uppercase;
+  background:transparent;color:var(--text);border:1px solid var(--border);padding:6px 14px;border-radius:3px;cursor:pointer;
+}
 
 ::-webkit-scrollbar{width:3px}
 ::-webkit-scrollbar-track{background:var(--bg)}
@@ -413,6 +2664,8 @@ header{
         <div class="f"><label>Overlap</label><input type="number" id="g_overlap" value="0.15" step="0.01"></div>
         <div class="f"><label>X Offset (mm)</label><input type="number" id="g_x_off" value="263" step="1"></div>
         <div class="f"><label>Y Offset (mm)</label><input type="number" id="g_y_off" value="266" step="1"></div>
+        <div class="f"><label>Resolution (px/mm)</label><input type="number" id="g_res" value="2.0" step="0.5"></div>
+        <div class="f"><label>Tile (px, 0 = off)</label><input type="number" id="g_tile" value="0" step="256"></div>
       </div>
     </div>
 
@@ -436,6 +2689,7 @@ header{
         <div class="f"><label>Spiral Loops</label><input type="number" id="g_dip_spiral_loops" value="1.0" step="0.5"></div>
         <div class="f"><label>Spiral Radius</label><input type="number" id="g_dip_spiral_r" value="50" step="5"></div>
         <div class="f"><label>Wipe Radius</label><input type="number" id="g_wipe_r" value="70" step="5"></div>
+        <div class="f"><label>Seed</label><input type="number" id="g_seed" placeholder="(random)" step="1"></div>
       </div>
     </div>
 
@@ -446,6 +2700,37 @@ header{
         <div class="f"><label>Feed Paint</label><input type="number" id="g_feed_paint" value="400" step="50"></div>
         <div class="f"><label>Accel Travel</label><input type="number" id="g_accel_travel" value="12000" step="500"></div>
         <div class="f"><label>Accel Paint</label><input type="number" id="g_accel_paint" value="200" step="50"></div>
+        <div class="f"><label>M400 Before M204</label>
+          <select id="g_accel_sync"><option value="0" selected>Off</option><option value="1">On</option></select></div>
+      </div>
+    </div>
+
+    <div class="sidebar-sec">
+      <div class="sec-title">Infill</div>
+      <div class="cfg-g s1">
+        <div class="f"><label>Concentric Metric</label>
+          <select id="g_concentric_metric">
+            <option value="taxicab" selected>Taxicab</option>
+            <option value="chessboard">Chebyshev</option>
+            <option value="euclidean">Euclidean</option>
+          </select></div>
+        <div class="f"><label>Zig-zag: Finish Each Region</label>
+          <select id="g_region_order"><option value="0" selected>Off</option><option value="1">On</option></select></div>
+      </div>
+    </div>
+
+    <div class="sidebar-sec">
+      <div class="sec-title">Path Optimization</div>
+      <div class="cfg-g">
+        <div class="f"><label>2-Opt Budget (s)</label><input type="number" id="g_opt_refine_time" value="0" step="0.5"></div>
+        <div class="f"><label>Simplify Tol (mm)</label><input type="number" id="g_simplify_tol" value="0.1" step="0.05"></div>
+        <div class="f"><label>Arc Tol (mm, 0 = off)</label><input type="number" id="g_arc_tol" value="0" step="0.05" min="0"></div>
+        <div class="f"><label>Schedule</label>
+          <select id="g_schedule">
+            <option value="travel" selected>Travel</option>
+            <option value="dips">Dips (whole strokes)</option>
+          </select></div>
+        <div class="f"><label>Dip Fill</label><input type="number" id="g_dip_fill" value="0.9" step="0.05" min="0" max="1"></div>
       </div>
     </div>
 
@@ -454,10 +2739,22 @@ header{
 
 <div class="gen-bar">
   <button class="btn-gen" id="btnGen" onclick="generate()">&#x2B21; Generate G-Code</button>
+  <button class="btn-cancel" id="btnCancel" onclick="cancelJob()">Cancel</button>
+  <button class="btn-view" id="btnView" onclick="openViewer()">Preview Paths</button>
   <div class="pw" id="pw"><div class="pb"><div class="pf" id="pf"></div></div></div>
   <div class="st" id="st">Load images for each active layer, then generate.</div>
 </div>
 
+<div class="viewer" id="viewer">
+  <canvas id="vcv"></canvas>
+  <div class="v-bar">
+    <label><input type="checkbox" id="vTravel" checked onchange="vDraw()">Travel</label>
+    <label><input type="checkbox" id="vDips" checked onchange="vDraw()">Dips</label>
+    <span class="v-info" id="vInfo"></span>
+    <button onclick="closeViewer()">Close</button>
+  </div>
+</div>
+
 <script>
 const C = ['#ff6b6b','#3dd6c8','#ffd166','#b06aff'];
 const LC = ['lc1','lc2','lc3','lc4'];
@@ -505,6 +2802,7 @@ function render(){
           <div class="f" style="grid-column:span 2"><label>Infill Type</label>
             <select onchange="state[${i}].infill_type=this.value">
               <option value="lines" ${s.infill_type=='lines'?'selected':''}>Lines</option>
+              <option value="zigzag" ${s.infill_type=='zigzag'?'selected':''}>Zig-zag</option>
               <option value="concentric" ${s.infill_type=='concentric'?'selected':''}>Concentric</option>
             </select></div>
           <div class="f"><label>Angle °</label>
@@ -540,7 +2838,7 @@ function drop(e,i){ e.preventDefault(); const f=e.dataTransfer.files[0]; if(f) u
 
 async function upload(file,i){
   setst(`Uploading layer ${i+1}…`,'');
-  const fd=new FormData(); fd.append('image',file); fd.append('layer',i);
+  const fd=new FormData(); fd.append('image',file); fd.append('layer',i); fd.append('inline',0);
   try{
     const r=await fetch('/upload_preview',{method:'POST',body:fd});
     const d=await r.json();
@@ -558,64 +2856,867 @@ function setst(m,t){const el=document.getElementById('st');el.textContent=m;el.c
 function gcfg(){
   const g=id=>parseFloat(document.getElementById('g_'+id).value)||0;
   return{target_width:g('target_width'),brush_w:g('brush_w'),overlap:g('overlap'),
-    x_off:g('x_off'),y_off:g('y_off'),z_paint:g('z_paint'),z_low:g('z_low'),
+    x_off:g('x_off'),y_off:g('y_off'),res:g('res'),tile:g('tile'),z_paint:g('z_paint'),z_low:g('z_low'),
     z_high:g('z_high'),z_wipe_exit:g('z_wipe_exit'),dip_z:g('dip_z'),
     min_dist:g('min_dist'),max_dist:g('max_dist'),dip_jitter:g('dip_jitter'),
     dip_spiral_loops:g('dip_spiral_loops'),dip_spiral_r:g('dip_spiral_r'),
     wipe_r:g('wipe_r'),feed:g('feed'),feed_paint:g('feed_paint'),
-    accel_travel:g('accel_travel'),accel_paint:g('accel_paint')};
+    accel_travel:g('accel_travel'),accel_paint:g('accel_paint'),
+    opt_refine_time:g('opt_refine_time'),simplify_tol:g('simplify_tol'),arc_tol:g('arc_tol'),
+    schedule:document.getElementById('g_schedule').value,dip_fill:g('dip_fill'),
+    concentric_metric:document.getElementById('g_concentric_metric').value,
+    region_order:document.getElementById('g_region_order').value==='1',
+    seed:document.getElementById('g_seed').value===''?null:parseInt(document.getElementById('g_seed').value),
+    accel_sync:document.getElementById('g_accel_sync').value==='1'};
 }
 
+function payload(){
+  return{global:gcfg(),layers:state.map(s=>({
+    name:s.name,enabled:s.enabled,image_path:s.image_path,
+    dip_x:s.dip_x,dip_y:s.dip_y,infill_type:s.infill_type,
+    infill_angle:s.infill_angle,brush_w:s.brush_w
+  }))};
+}
+
+let jobId=null;
+
 async function generate(){
   const active=state.filter(s=>s.enabled&&s.image_path);
   if(!active.length){setst('No active layers with images loaded.','err');return;}
   const btn=document.getElementById('btnGen');
+  const cb=document.getElementById('btnCancel');
   const pw=document.getElementById('pw');
   const pf=document.getElementById('pf');
+  const finish=()=>{jobId=null;cb.classList.remove('vis');
+    setTimeout(()=>{btn.disabled=false;pw.classList.remove('vis');pf.style.width='0%';},1500);};
   btn.disabled=true; pw.classList.add('vis'); pf.style.width='0%';
-  setst(`Processing ${active.length} layer(s) — this may take a moment…`,'');
-  let p=0; const iv=setInterval(()=>{p=Math.min(p+2,88);pf.style.width=p+'%';},250);
+  setst(`Queued ${active.length} layer(s)…`,'');
   try{
-    const r=await fetch('/generate',{
-      method:'POST',headers:{'Content-Type':'application/json'},
-      body:JSON.stringify({global:gcfg(),layers:state.map(s=>({
-        name:s.name,enabled:s.enabled,image_path:s.image_path,
-        dip_x:s.dip_x,dip_y:s.dip_y,infill_type:s.infill_type,
-        infill_angle:s.infill_angle,brush_w:s.brush_w
-      }))})
-    });
-    clearInterval(iv); pf.style.width='100%';
-    if(!r.ok){const d=await r.json();setst('Error: '+(d.error||r.statusText),'err');}
-    else{
-      const blob=await r.blob();
-      const a=document.createElement('a');
-      a.href=URL.createObjectURL(blob);a.download='multicolor_paint.gcode';a.click();
-      setst(`✓ G-code for ${active.length} layer(s) downloaded.`,'ok');
+    const r=await fetch('/jobs',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify(payload())});
+    const d=await r.json();
+    if(!r.ok){setst('Error: '+(d.error||r.statusText),'err');finish();return;}
+    jobId=d.id; cb.classList.add('vis');
+    const es=new EventSource(`/jobs/${d.id}/events`);
+    es.onmessage=e=>{
+      const s=JSON.parse(e.data);
+      pf.style.width=(s.progress*100)+'%';
+      if(s.state==='running'){
+        const cur=Object.entries(s.layers).find(([k,l])=>!(l.stage==='emit'&&l.progress>=1));
+        if(cur) setst(`Layer ${+cur[0]+1} · ${cur[1].stage} ${Math.round(cur[1].progress*100)}%`,'');
+      }else if(s.state==='done'){
+        es.close();
+        const a=document.createElement('a');
+        a.href=`/jobs/${s.id}/result`;a.download='multicolor_paint.gcode';a.click();
+        lastJob=s.id;document.getElementById('btnView').classList.add('vis');
+        const saved=Object.values(s.stats||{}).filter(l=>'dips_saved' in l).reduce((n,l)=>n+l.dips_saved,null);
+        const est=s.estimate?` · est. ${fmtDur(s.estimate.time_s)} machine time, ${s.estimate.dips} dips`+
+          (saved===null?'':` (${saved} saved)`):'';
+        const fitted=Object.values(s.stats||{}).filter(l=>'arcs' in l);
+        const arcs=fitted.length?` · ${fitted.reduce((n,l)=>n+l.arcs,0)} arcs, `+
+          `${fitted.reduce((n,l)=>n+l.arc_lines_saved,0)} fewer lines`:'';
+        setst(`✓ G-code for ${active.length} layer(s) downloaded${est}${arcs}.`,'ok');finish();
+      }else if(s.state==='failed'||s.state==='cancelled'){
+        es.close();setst(s.state==='failed'?'Failed: '+s.error:'Cancelled.','err');finish();
+      }
+    };
+    es.onerror=()=>{es.close();setst('Lost connection to job '+d.id,'err');finish();};
+  }catch(e){setst('Failed: '+e,'err');finish();}
+}
+
+function fmtDur(t){t=Math.round(t);return `${Math.floor(t/3600)}h ${String(Math.floor(t%3600/60)).padStart(2,'0')}m`;}
+
+function cancelJob(){ if(jobId) fetch(`/jobs/${jobId}/cancel`,{method:'POST'}); }
+
+// ── Toolpath viewer: binary levels of detail from /jobs/<id>/toolpath, fetched as zoom needs them
+const LOD_TOL={{ lod_tol|tojson }};
+let lastJob=null, view=null;
+
+function vParse(buf){
+  const h=new Uint32Array(buf,4,5), f=new Float32Array(buf,24,5);
+  const [lod,np,nv,nt,nd]=h;
+  let o=44;
+  const xy=new Float32Array(buf,o,nv*2); o+=nv*8;
+  const off=new Uint32Array(buf,o,np+1); o+=(np+1)*4;
+  const tr=new Float32Array(buf,o,nt*4); o+=nt*16;
+  const dp=new Float32Array(buf,o,nd*2); o+=nd*8;
+  const pl=new Uint8Array(buf,o,np); o+=np;
+  const tl=new Uint8Array(buf,o,nt); o+=nt;
+  const dl=new Uint8Array(buf,o,nd);
+  const paint=C.map(()=>new Path2D()), travel=new Path2D();
+  for(let p=0;p<np;p++){
+    const path=paint[pl[p]%C.length];
+    path.moveTo(xy[2*off[p]],xy[2*off[p]+1]);
+    for(let v=off[p]+1;v<off[p+1];v++) path.lineTo(xy[2*v],xy[2*v+1]);
+  }
+  for(let t=0;t<nt;t++){ travel.moveTo(tr[4*t],tr[4*t+1]); travel.lineTo(tr[4*t+2],tr[4*t+3]); }
+  return {lod,tol:f[0],bounds:[f[1],f[2],f[3],f[4]],np,nv,nt,nd,paint,travel,dp,dl};
+}
+
+async function vLoad(k){
+  if(view.levels[k]||view.pending[k]) return;
+  view.pending[k]=true;
+  const job=view.job, r=await fetch(`/jobs/${job}/toolpath?lod=${k}`);
+  if(!view||view.job!==job) return;
+  if(!r.ok){document.getElementById('vInfo').textContent='Preview failed: '+r.statusText;return;}
+  view.levels[k]=vParse(await r.arrayBuffer());
+  if(!view.fitted) vFit();
+  vDraw();
+}
+
+function vWant(){
+  // coarsest level whose tolerance is still under a screen pixel
+  let k=0;
+  LOD_TOL.forEach((t,i)=>{ if(t<=1/view.scale) k=i; });
+  return k;
+}
+
+function vFit(){
+  const L=Object.values(view.levels)[0]; if(!L) return;
+  const cv=document.getElementById('vcv'), [x0,y0,x1,y1]=L.bounds;
+  view.scale=0.92*Math.min(cv.clientWidth/Math.max(x1-x0,1),cv.clientHeight/Math.max(y1-y0,1));
+  view.ox=cv.clientWidth/2-(x0+x1)/2*view.scale;
+  view.oy=cv.clientHeight/2+(y0+y1)/2*view.scale;
+  view.fitted=true;
+}
+
+function vDraw(){
+  if(!view) return;
+  const cv=document.getElementById('vcv'), ctx=cv.getContext('2d'), dpr=window.devicePixelRatio||1;
+  cv.width=cv.clientWidth*dpr; cv.height=cv.clientHeight*dpr;
+  ctx.setTransform(1,0,0,1,0,0); ctx.fillStyle='#0c0d10'; ctx.fillRect(0,0,cv.width,cv.height);
+  if(!view.fitted) return;
+  const want=vWant(); vLoad(want);
+  const have=Object.keys(view.levels).map(Number);
+  if(!have.length) return;
+  const k=view.levels[want]?want:have.reduce((a,b)=>Math.abs(b-want)<Math.abs(a-want)?b:a);
+  const L=view.levels[k], s=view.scale;
+  ctx.setTransform(s*dpr,0,0,-s*dpr,view.ox*dpr,view.oy*dpr);
+  ctx.lineCap=ctx.lineJoin='round';
+  if(document.getElementById('vTravel').checked){
+    ctx.lineWidth=1/s; ctx.setLineDash([4/s,4/s]); ctx.strokeStyle='rgba(196,201,218,.22)'; ctx.stroke(L.travel);
+    ctx.setLineDash([]);
+  }
+  ctx.lineWidth=Math.max(parseFloat(document.getElementById('g_brush_w').value)||1,1/s);
+  L.paint.forEach((path,i)=>{ ctx.strokeStyle=C[i]; ctx.stroke(path); });
+  ctx.setTransform(dpr,0,0,dpr,0,0);
+  if(document.getElementById('vDips').checked){
+    ctx.lineWidth=1.5;
+    for(let d=0;d<L.nd;d++){
+      ctx.strokeStyle=C[L.dl[d]%C.length]; ctx.beginPath();
+      ctx.arc(view.ox+L.dp[2*d]*s,view.oy-L.dp[2*d+1]*s,5,0,2*Math.PI); ctx.stroke();
     }
-  }catch(e){clearInterval(iv);setst('Failed: '+e,'err');}
-  setTimeout(()=>{btn.disabled=false;pw.classList.remove('vis');pf.style.width='0%';},1500);
+  }
+  document.getElementById('vInfo').textContent=
+    `LOD ${k} (${L.tol} mm) · ${L.nv.toLocaleString()} vertices · ${L.np.toLocaleString()} paths · `+
+    `${L.nt.toLocaleString()} travel moves · ${L.nd} dips`+(k!==want?' · loading…':'');
 }
 
+function openViewer(){
+  if(!lastJob) return;
+  view={job:lastJob,levels:{},pending:{},scale:1,ox:0,oy:0,fitted:false};
+  document.getElementById('viewer').classList.add('vis');
+  document.getElementById('vInfo').textContent='Loading…';
+  vLoad(LOD_TOL.length-1);
+}
+
+function closeViewer(){ view=null; document.getElementById('viewer').classList.remove('vis'); }
+
+(()=>{
+  const cv=document.getElementById('vcv');
+  let drag=null;
+  cv.addEventListener('wheel',e=>{
+    if(!view||!view.fitted) return;
+    e.preventDefault();
+    const z=Math.pow(1.2,-e.deltaY/100), mx=(e.offsetX-view.ox)/view.scale, my=(view.oy-e.offsetY)/view.scale;
+    view.scale*=z; view.ox=e.offsetX-mx*view.scale; view.oy=e.offsetY+my*view.scale;
+    vDraw();
+  },{passive:false});
+  cv.addEventListener('mousedown',e=>{ drag=[e.clientX,e.clientY]; });
+  window.addEventListener('mouseup',()=>{ drag=null; });
+  window.addEventListener('mousemove',e=>{
+    if(!drag||!view) return;
+    view.ox+=e.clientX-drag[0]; view.oy+=e.clientY-drag[1]; drag=[e.clientX,e.clientY]; vDraw();
+  });
+  cv.addEventListener('dblclick',()=>{ if(view){ vFit(); vDraw(); } });
+  window.addEventListener('keydown',e=>{ if(e.key==='Escape'&&view) closeViewer(); });
+  window.addEventListener('resize',()=>vDraw());
+})();
+
 render();
 </script>
 </body>
 </html>"""
 
 # ─────────────────────────────────────────────
-# MAIN
+# CLI
 # ─────────────────────────────────────────────
 
-def open_browser():
+# UI defaults; a job spec only needs to name what differs.
+DEFAULT_CFG = {
+    'target_width': 1070, 'brush_w': 1.6, 'overlap': 0.15, 'x_off': 263, 'y_off': 266,
+    'z_paint': 0.0, 'z_low': 4.6, 'z_high': 31.0, 'z_wipe_exit': 16.0, 'dip_z': 0.0,
+    'min_dist': 240, 'max_dist': 280, 'dip_jitter': 20, 'dip_spiral_loops': 1.0,
+    'dip_spiral_r': 50, 'wipe_r': 70, 'feed': 12000, 'feed_paint': 400,
+    'accel_travel': 12000, 'accel_paint': 200, 'opt_refine_time': 0, 'simplify_tol': 0.1,
+    'concentric_metric': 'taxicab', 'seed': None, 'accel_sync': False, 'schedule': 'travel', 'dip_fill': 0.9,
+    'arc_tol': 0, 'region_order': False, 'infill_workers': 0,
+    'res': 2.0, 'tile': 0, 'mask_store': 'memory',
+}
+DISHES = [(66, 862), (66, 700), (66, 538), (66, 376)]
+SPEC_SUFFIXES = ('.json', '.toml')
+IMAGE_SUFFIXES = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tif', '.tiff', '.webp')
+
+def load_spec(path):
+    if path.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:
+            raise ValueError(f"{path}: TOML job specs need Python 3.11+; use JSON instead")
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+    with open(path) as f:
+        return json.load(f)
+
+def spec_layers(spec, base_dir='.'):
+    # A spec is the /generate body ({"global": {...}, "layers": [...]}) with two
+    # shorthands per layer: "image" (relative to the spec file) for image_path and
+    # "dish" (1-4) for the petri dish position. Layers default to dishes in order.
+    global_cfg = {**DEFAULT_CFG, **spec.get('global', {})}
+    layers = []
+    for i, layer in enumerate(spec.get('layers', [])):
+        layer = dict(layer)
+        if 'image' in layer: layer['image_path'] = os.path.join(base_dir, layer.pop('image'))
+        dish = DISHES[(int(layer.pop('dish', i % len(DISHES) + 1)) - 1) % len(DISHES)]
+        layer.setdefault('dip_x', dish[0])
+        layer.setdefault('dip_y', dish[1])
+        layer.setdefault('enabled', True)
+        layer.setdefault('name', f'Color {i+1}')
+        layers.append(layer)
+    layers, error = active_layers({'global': global_cfg, 'layers': layers})
+    if error: raise ValueError(error)
+    if not layers: raise ValueError("job has no enabled layers with an image")
+    return global_cfg, layers
+
+def write_program(path, lines):
+    tmp = path + '.part'
+    try:
+        with open(tmp, 'wb') as f:
+            for chunk in iter_chunks(lines):
+                f.write(chunk)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+
+def run_spec(spec, base_dir, out_path, overrides=None):
+    # Plans one job spec into out_path and returns a short summary.
+    start = time.perf_counter()
+    global_cfg, layers = spec_layers(spec, base_dir)
+    global_cfg = with_seed({**global_cfg, **(overrides or {})})
+    stats, report = {}, {}
+    lines = program_lines(global_cfg, layers, stats=stats.__setitem__)
+    write_program(out_path, with_estimate(lines, global_cfg, report.update))
+    saved = [st['dips_saved'] for st in stats.values() if 'dips_saved' in st]
+    fitted = [st for st in stats.values() if 'arcs' in st]
+    return {'output': out_path, 'layers': len(layers), 'seed': global_cfg['seed'],
+            'seconds': round(time.perf_counter() - start, 3), 'paths': sum(st['paths'] for st in stats.values()),
+            'estimate_s': report['time_s'], 'dips': report['dips'], 'dips_saved': sum(saved) if saved else None,
+            'arcs': sum(st['arcs'] for st in fitted) if fitted else None,
+            'arc_lines_saved': sum(st['arc_lines_saved'] for st in fitted) if fitted else None}
+
+def collect_jobs(paths, out_dir=None):
+    # Expands spec files, images and directories of either into (spec, base_dir, out_path).
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found += sorted(os.path.join(path, n) for n in os.listdir(path)
+                            if n.lower().endswith(SPEC_SUFFIXES + IMAGE_SUFFIXES))
+        else:
+            found.append(path)
+    jobs = []
+    for path in found:
+        base_dir, name = os.path.split(os.path.abspath(path))
+        stem = os.path.splitext(name)[0]
+        if path.lower().endswith(IMAGE_SUFFIXES):
+            spec, out = {'layers': [{'image': name}]}, None
+        else:
+            spec = load_spec(path)
+            out = spec.get('output')
+        out = os.path.join(out_dir or base_dir, out or stem + '.gcode')
+        jobs.append((spec, base_dir, out))
+    return jobs
+
+def run_jobs(jobs, workers=None, overrides=None, log=print):
+    # With several jobs, jobs fan out over processes and each plans its layers
+    # serially; a single job parallelises over its layers instead.
+    workers = min(len(jobs), int(workers or os.cpu_count() or 1))
+    failed = 0
+    def report(out, result=None, error=None):
+        nonlocal failed
+        if error is not None:
+            failed += 1
+            log(f"  FAILED  {out}: {error}")
+        else:
+            saved = '' if result['dips_saved'] is None else f" ({result['dips_saved']} saved)"
+            arcs = '' if result['arcs'] is None else f" {result['arcs']} arcs (-{result['arc_lines_saved']} lines),"
+            log(f"  {result['seconds']:7.2f}s  {out}  ({result['layers']} layer(s), {result['paths']} paths,{arcs}"
+                f" {result['dips']} dips{saved}, est. {fmt_duration(result['estimate_s'])}, seed {result['seed']})")
+    if workers <= 1:
+        for spec, base_dir, out in jobs:
+            try:
+                report(out, run_spec(spec, base_dir, out, overrides))
+            except Exception as e:
+                report(out, error=e)
+        return failed
+    overrides = {**(overrides or {}), 'workers': 1, 'infill_workers': 1}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_spec, spec, base_dir, out, overrides): out for spec, base_dir, out in jobs}
+        for fut in as_completed(futures):
+            try:
+                report(futures[fut], fut.result())
+            except Exception as e:
+                report(futures[fut], error=e)
+    return failed
+
+def run_analysis(jobs, overrides=None, heatmap_dir=None, sweep=None, log=print):
+    # Coverage report for every layer of every job; sweep = (key, values) re-plans
+    # each layer once per value.
+    key, values = sweep or (None, [None])
+    for spec, base_dir, out in jobs:
+        global_cfg, layers = spec_layers(spec, base_dir)
+        global_cfg = with_seed({**global_cfg, **(overrides or {})})
+        stem = os.path.splitext(os.path.basename(out))[0]
+        log(f"  {stem}")
+        for i, layer in layers:
+            for value in values:
+                cfg = layer_cfg(global_cfg, layer)
+                if key: cfg[key] = value
+                tag = f"_{key}{value}" if key else ''
+                heat = heatmap_dir and os.path.join(heatmap_dir, f"{stem}_layer{i+1}{tag}.png")
+                r = analyze_layer(cfg, layer['image_path'], heat)
+                log(f"    layer {i+1}{f' {key}={value}' if key else ''}: {r['coverage_pct']:.2f}% covered, "
+                    f"{r['missed_mm2']:.0f} mm² missed, {r['spill_mm2']:.0f} mm² off target, overpaint {r['overpaint']:.2f}, "
+                    f"{r['strokes']} strokes, {r['stroke_mm'] / 1000:.1f} m ({r['wasted_pct']:.1f}% wasted)")
+
+def parse_overrides(pairs):
+    out = {}
+    for pair in pairs or ():
+        key, _, value = pair.partition('=')
+        try:
+            out[key] = json.loads(value)
+        except ValueError:
+            out[key] = value
+    return out
+
+def open_browser(url):
     time.sleep(1.2)
-    webbrowser.open('http://127.0.0.1:5000')
+    webbrowser.open(url)
 
-if __name__ == '__main__':
+def serve(port=5000, browser=True):
+    app = create_app()
+    url = f'http://127.0.0.1:{port}'
     print("\n  ╔══════════════════════════════════════╗")
     print("  ║  PAINTER G-CODE STUDIO              ║")
-    print("  ║  Opening → http://127.0.0.1:5000    ║")
+    print(f"  ║  Opening → {url:<26}║")
     print("  ╚══════════════════════════════════════╝\n")
-    threading.Thread(target=open_browser, daemon=True).start()
+    if browser: threading.Thread(target=open_browser, args=(url,), daemon=True).start()
     import logging
     log = logging.getLogger('werkzeug')
     log.setLevel(logging.ERROR)
-    app.run(debug=False, port=5000)
+    app.run(debug=False, port=port)
+
+COMMANDS = ('serve', 'convert', 'run', 'analyze', 'bench', 'send', 'emulate')
+
+def main(argv):
+    if argv and argv[0] not in COMMANDS and not argv[0].startswith('-'):
+        argv = ['convert'] + argv  # python painter_ui.py input.png output.gcode
+    ap = argparse.ArgumentParser(prog='painter_ui.py', description='Painter G-code studio.')
+    sub = ap.add_subparsers(dest='command')
+    p = sub.add_parser('serve', help='run the web UI (the default)')
+    p.add_argument('--port', type=int, default=5000)
+    p.add_argument('--no-browser', action='store_true')
+    p = sub.add_parser('convert', help='convert one image into a single-layer program')
+    p.add_argument('image')
+    p.add_argument('output')
+    p.add_argument('--dish', type=int, default=1, help='petri dish 1-4')
+    p.add_argument('--infill', choices=('lines', 'zigzag', 'concentric'), default='lines')
+    p.add_argument('--angle', type=float, default=0)
+    p.add_argument('--set', action='append', metavar='KEY=VALUE', help='override a global setting')
+    p = sub.add_parser('run', help='run job specs (.json/.toml), images, or directories of them')
+    p.add_argument('paths', nargs='+')
+    p.add_argument('-o', '--out-dir', help='write programs here instead of next to each spec')
+    p.add_argument('-j', '--jobs', type=int, help='jobs planned in parallel (default: all cores)')
+    p.add_argument('--set', action='append', metavar='KEY=VALUE', help='override a global setting in every job')
+    p = sub.add_parser('analyze', help='coverage and overpaint of the planned strokes against the artwork')
+    p.add_argument('paths', nargs='+')
+    p.add_argument('--heatmap-dir', help='write a heat-map PNG per layer here')
+    p.add_argument('--sweep', metavar='KEY=V1,V2,...', help='analyze once per value of a setting, e.g. overlap=0,0.1,0.2')
+    p.add_argument('--set', action='append', metavar='KEY=VALUE', help='override a global setting in every job')
+    sub.add_parser('bench', help='benchmark the planning pipeline', add_help=False)
+    sub.add_parser('send', help='stream a program to the controller', add_help=False)
+    sub.add_parser('emulate', help='controller stand-in for testing send', add_help=False)
+    args, rest = ap.parse_known_args(argv)
+    if args.command == 'bench':
+        return bench_main(rest)
+    if args.command == 'send':
+        return send_main(rest)
+    if args.command == 'emulate':
+        return emulate_main(rest)
+    if rest: ap.error('unrecognized arguments: ' + ' '.join(rest))
+    if args.command == 'convert':
+        layer = {'image': os.path.abspath(args.image), 'dish': args.dish, 'infill_type': args.infill, 'infill_angle': args.angle}
+        return run_jobs([({'layers': [layer]}, '.', args.output)], 1, parse_overrides(args.set))
+    if args.command == 'run':
+        try:
+            jobs = collect_jobs(args.paths, args.out_dir)
+        except (OSError, ValueError) as e:
+            ap.error(str(e))
+        if args.out_dir: os.makedirs(args.out_dir, exist_ok=True)
+        failed = run_jobs(jobs, args.jobs, parse_overrides(args.set))
+        print(f"\n  {len(jobs) - failed}/{len(jobs)} job(s) done")
+        return 1 if failed else 0
+    if args.command == 'analyze':
+        try:
+            jobs = collect_jobs(args.paths)
+        except (OSError, ValueError) as e:
+            ap.error(str(e))
+        sweep = None
+        if args.sweep:
+            key, _, values = args.sweep.partition('=')
+            sweep = (key, [parse_overrides([f"{key}={v}"])[key] for v in values.split(',')])
+        if args.heatmap_dir: os.makedirs(args.heatmap_dir, exist_ok=True)
+        run_analysis(jobs, parse_overrides(args.set), args.heatmap_dir, sweep)
+        return 0
+    serve(getattr(args, 'port', 5000), not getattr(args, 'no_browser', False))
+    return 0
+
+
+# ─────────────────────────────────────────────
+# BENCHMARK
+# ─────────────────────────────────────────────
+
+BENCH_IMAGES = ('solid', 'line_art', 'noise', 'islands', 'blobs')
+BENCH_CASES = [('lines', 0), ('lines', 30), ('lines', 45), ('lines', 90), ('zigzag', 0), ('concentric', 0)]
+BENCH_CFG = {**DEFAULT_CFG, 'dip_x': DISHES[0][0], 'dip_y': DISHES[0][1], 'seed': 1, 'cache': False}
+
+def bench_image(kind, w=1000, h=750, seed=0):
+    # Synthetic test artwork; True = paint.
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:h, 0:w]
+    if kind == 'solid':
+        return (xx > w*0.05) & (xx < w*0.95) & (yy > h*0.05) & (yy < h*0.95)
+    if kind == 'noise':
+        return rng.random((h, w)) < 0.5
+    if kind == 'islands':
+        arr = np.zeros((h, w), bool)
+        for cx, cy, r in zip(rng.integers(0, w, 1500), rng.integers(0, h, 1500), rng.integers(2, 7, 1500)):
+            arr[max(0, cy-r):cy+r, max(0, cx-r):cx+r] |= (xx[max(0, cy-r):cy+r, max(0, cx-r):cx+r]-cx)**2 + (yy[max(0, cy-r):cy+r, max(0, cx-r):cx+r]-cy)**2 < r*r
+        return arr
+    if kind == 'blobs':
+        arr = np.zeros((h, w), bool)
+        for cx, cy, r in ((w*0.3, h*0.45, h*0.35), (w*0.72, h*0.55, h*0.3), (w*0.55, h*0.2, h*0.12)):
+            arr |= (xx-cx)**2 + (yy-cy)**2 < r*r
+        return arr
+    if kind == 'line_art':
+        img = Image.new('L', (w, h), 255)
+        draw = ImageDraw.Draw(img)
+        for _ in range(120):
+            pts = [tuple(p) for p in rng.integers(0, (w, h), (4, 2)).tolist()]
+            draw.line(pts, fill=0, width=2)
+        return np.array(img) < 140
+    raise ValueError(f'unknown bench image {kind!r}')
+
+def bench_case(img_path, cfg, repeat=1):
+    # Times each pipeline stage separately; best of `repeat` runs.
+    best = {}
+    for _ in range(repeat):
+        painter = UltraPainter(cfg)
+        t = {}
+        t0 = time.perf_counter(); arr = painter.load_mask(img_path)
+        t1 = time.perf_counter(); raw = painter.trace_paths(arr)
+        t2 = time.perf_counter(); paths = PathOptimizer.optimize(raw, (cfg['dip_x'], cfg['dip_y']), cfg.get('opt_refine_time', 0))
+        t3 = time.perf_counter(); paths = PathSimplifier.simplify(paths, cfg.get('simplify_tol', 0))
+        t4 = time.perf_counter(); n_lines = sum(1 for _ in painter.emit(paths))
+        t5 = time.perf_counter()
+        t = {'load_s': t1-t0, 'infill_s': t2-t1, 'optimize_s': t3-t2, 'simplify_s': t4-t3, 'emit_s': t5-t4, 'total_s': t5-t0}
+        best = {k: min(v, best.get(k, v)) for k, v in t.items()}
+    return {**{k: round(v, 4) for k, v in best.items()},
+            'paths': len(paths), 'points': paths.n_points, 'gcode_lines': n_lines}
+
+def run_bench(widths=(300, 1070), images=BENCH_IMAGES, repeat=1, log=print):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind in images:
+            img_path = os.path.join(tmp, kind + '.png')
+            Image.fromarray(np.where(bench_image(kind), 0, 255).astype(np.uint8)).save(img_path)
+            for width in widths:
+                for infill, angle in BENCH_CASES:
+                    name = f"{kind}/w{width:g}/{infill}" + (f"@{angle}" if infill != 'concentric' else '')
+                    cfg = {**BENCH_CFG, 'target_width': width, 'infill_type': infill, 'infill_angle': angle}
+                    results[name] = bench_case(img_path, cfg, repeat)
+                    r = results[name]
+                    log(f"  {name:<32} {r['total_s']:8.3f}s  {r['paths']:7d} paths {r['points']:9d} pts {r['gcode_lines']:9d} lines")
+    return {'meta': {'python': sys.version.split()[0], 'numpy': np.__version__, 'created': time.strftime('%Y-%m-%d %H:%M:%S')},
+            'cases': results}
+
+def compare_bench(baseline, current, threshold=1.25, floor=0.05):
+    # A stage regresses when it is `threshold` times slower and at least `floor` seconds slower.
+    regressions, changes = [], []
+    for name, cur in current['cases'].items():
+        old = baseline['cases'].get(name)
+        if old is None: continue
+        for k, v in cur.items():
+            if k.endswith('_s') and k in old and v > old[k] * threshold and v - old[k] > floor:
+                regressions.append(f"{name} {k}: {old[k]:.3f}s -> {v:.3f}s ({v / max(old[k], 1e-9):.2f}x)")
+            elif not k.endswith('_s') and old.get(k) != v:
+                changes.append(f"{name} {k}: {old.get(k)} -> {v}")
+    return regressions, changes
+
+def bench_main(argv):
+    ap = argparse.ArgumentParser(prog='bench', description='Benchmark the planning pipeline on synthetic images.')
+    ap.add_argument('-o', '--out', help='write results as a JSON baseline')
+    ap.add_argument('-c', '--compare', help='baseline JSON to compare against')
+    ap.add_argument('--widths', default='300,1070', help='comma-separated target widths in mm')
+    ap.add_argument('--images', default=','.join(BENCH_IMAGES))
+    ap.add_argument('--repeat', type=int, default=1)
+    ap.add_argument('--threshold', type=float, default=1.25, help='slowdown ratio flagged as a regression')
+    args = ap.parse_args(argv)
+    current = run_bench([float(w) for w in args.widths.split(',')], args.images.split(','), args.repeat)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(current, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions, changes = compare_bench(json.load(f), current, args.threshold)
+        for line in changes: print("  changed   " + line)
+        for line in regressions: print("  REGRESSED " + line)
+        print(f"\n  {len(regressions)} regression(s), {len(changes)} output change(s)")
+        return 1 if regressions else 0
+    return 0
+
+
+# ─────────────────────────────────────────────
+# SENDER
+# ─────────────────────────────────────────────
+
+class StreamLink:
+    # A serial device, pty or TCP socket (tcp://host:port), read and written as raw
+    # bytes. termios sets serial lines raw at the given baud, so no serial library
+    # is needed.
+    def __init__(self, target, baud=115200):
+        self.target, self.sock = target, None
+        if target.startswith('tcp://'):
+            import socket
+            host, _, port = target[6:].rpartition(':')
+            self.sock = socket.create_connection((host or '127.0.0.1', int(port)), timeout=10)
+            self.sock.settimeout(None)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.fd = self.sock.fileno()
+        else:
+            import termios, tty
+            speed = getattr(termios, f'B{baud}', None)
+            if speed is None: raise ValueError(f'unsupported baud rate {baud}')
+            self.fd = os.open(target, os.O_RDWR | os.O_NOCTTY)
+            tty.setraw(self.fd)
+            attrs = termios.tcgetattr(self.fd)
+            attrs[4] = attrs[5] = speed
+            termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+
+    @classmethod
+    def wrap(cls, fd, sock=None, name=''):
+        # An already open descriptor or socket, e.g. the emulator's end of the link.
+        link = cls.__new__(cls)
+        link.target, link.sock, link.fd = name, sock, fd
+        return link
+
+    def read(self, timeout=None):
+        # Whatever arrived within timeout seconds (b'' if nothing); raises once closed.
+        import select
+        if not select.select([self.fd], [], [], timeout)[0]: return b''
+        try:
+            data = self.sock.recv(65536) if self.sock else os.read(self.fd, 65536)
+        except OSError:
+            data = b''  # a pty whose other end closed reads EIO
+        if not data: raise ConnectionError(f'{self.target}: link closed')
+        return data
+
+    def write(self, data):
+        if self.sock:
+            self.sock.sendall(data)
+            return
+        view = memoryview(data)
+        while view: view = view[os.write(self.fd, view):]
+
+    def close(self):
+        if self.sock: self.sock.close()
+        else: os.close(self.fd)
+
+def program_commands(lines, from_line=1, from_layer=None, safe_z=None):
+    # Numbers program lines (blocks may hold several) from 1 as in the written file,
+    # strips comments and yields (line, layer, command) from the resume point on.
+    # Resuming skips what comes before, then rebuilds the state the skipped lines
+    # set up: units, acceleration and feed, and the brush position, approached
+    # from safe_z (default: the highest Z seen).
+    n, layer, started = 0, 0, from_line <= 1 and not from_layer
+    pos, feed, travel, top, accel = {}, None, None, None, None
+    for block in lines:
+        for text in block.split("\n"):
+            n += 1
+            if text.startswith('; LAYER '): layer = int(text[8:].partition(':')[0])
+            cmd = text.partition(';')[0].strip()
+            if not started:
+                started = layer == from_layer if from_layer else n >= from_line
+                if started:
+                    z = safe_z if safe_z is not None else top
+                    yield n, layer, "G90"
+                    yield n, layer, "G21"
+                    if accel: yield n, layer, accel
+                    if z is not None: yield n, layer, f"G0 Z{z:.3f} F3000"
+                    if 'X' in pos and 'Y' in pos:
+                        yield n, layer, f"G0 X{pos['X']:.3f} Y{pos['Y']:.3f}" + (f" F{travel:g}" if travel else "")
+                    if 'Z' in pos: yield n, layer, f"G0 Z{pos['Z']:.3f} F3000"
+                    if feed: yield n, layer, f"G1 F{feed:g}"
+            if not cmd: continue
+            if started:
+                yield n, layer, cmd
+                continue
+            words = cmd.split()
+            if words[0] in ('G0', 'G1', 'G2', 'G3'):
+                for w in words[1:]:
+                    if w[0] in 'XYZ': pos[w[0]] = float(w[1:])
+                    elif w[0] == 'F': feed = float(w[1:])
+                if 'Z' in pos: top = pos['Z'] if top is None else max(top, pos['Z'])
+                if words[0] == 'G0' and feed and any(w[0] in 'XY' for w in words[1:]):
+                    travel = feed if travel is None else max(travel, feed)
+            elif words[0] == 'M204':
+                accel = cmd
+    if not started:
+        raise ValueError(f'program has no layer {from_layer}' if from_layer else f'program has only {n} lines')
+
+class GcodeSender:
+    # Streams a program with character counting: lines go out while the bytes sent
+    # but not yet acknowledged fit the controller's receive buffer, so the buffer
+    # stays full instead of the link idling for a round trip per line. Every `ok`,
+    # and grbl's `error:`, acknowledges the oldest line in flight. Replies in
+    # Marlin's ADVANCED_OK form (ok N.. P<planner free> B<buffer free>) also cap the
+    # lines in flight at what the command buffer can take; max_lines=1 is the
+    # plain send-and-wait protocol.
+    def __init__(self, link, rx_buffer=128, max_lines=None, timeout=30.0, stop_on_error=True,
+                 progress=None, interval=1.0):
+        self.link, self.rx_buffer, self.max_lines = link, rx_buffer, max_lines
+        self.timeout, self.stop_on_error = timeout, stop_on_error
+        self.progress, self.interval = progress, interval
+
+    def stream(self, commands):
+        # commands: (line, layer, command) tuples, e.g. from program_commands
+        inflight = deque()  # (line, layer, bytes, time sent)
+        used, cap, pending = 0, self.max_lines, b''
+        st = {'lines': 0, 'bytes': 0, 'errors': [], 'line': 0, 'layer': 0, 'rtt_s': 0.0, 'planner_free': None}
+        t0 = last = time.perf_counter()
+        it = iter(commands)
+        nxt = next(it, None)
+        while nxt is not None or inflight:
+            out = []
+            while nxt is not None and (cap is None or len(inflight) < cap):
+                data = (nxt[2] + "\n").encode()
+                if inflight and used + len(data) > self.rx_buffer: break
+                inflight.append((nxt[0], nxt[1], len(data), time.perf_counter()))
+                used += len(data)
+                out.append(data)
+                nxt = next(it, None)
+            if out: self.link.write(b"".join(out))
+            data = self.link.read(self.timeout if inflight else 0)
+            if not data and inflight:
+                raise TimeoutError(f'no reply to line {inflight[0][0]} within {self.timeout:g}s')
+            pending += data
+            *replies, pending = pending.split(b"\n")
+            now = time.perf_counter()
+            for reply in replies:
+                reply = reply.strip().decode(errors='replace')
+                if reply.startswith('ALARM') or reply.startswith('!!'):
+                    raise RuntimeError(f'controller halted after line {st["line"]}: {reply}')
+                if reply.startswith('<') and 'Bf:' in reply:  # grbl status report
+                    st['planner_free'] = int(reply.partition('Bf:')[2].split(',')[0])
+                if not (reply.startswith('ok') or reply.startswith('error')) or not inflight: continue
+                line, layer, size, sent = inflight.popleft()
+                used -= size
+                st['lines'] += 1; st['bytes'] += size; st['line'], st['layer'] = line, layer
+                st['rtt_s'] += now - sent
+                if reply.startswith('error'):
+                    st['errors'].append((line, reply))
+                    if self.stop_on_error: raise RuntimeError(f'line {line}: {reply}')
+                words = reply.split()
+                free = [int(w[1:]) for w in words if w[0] == 'B' and w[1:].isdigit()]
+                if free: cap = max(1, min(self.max_lines or len(inflight) + free[0], len(inflight) + free[0]))
+                planner = [int(w[1:]) for w in words if w[0] == 'P' and w[1:].isdigit()]
+                if planner: st['planner_free'] = planner[0]
+            if self.progress and now - last >= self.interval:
+                last = now
+                self.progress(self._rates(st, now - t0))
+        return self._rates(st, time.perf_counter() - t0)
+
+    def _rates(self, st, seconds):
+        return {**st, 'seconds': round(seconds, 3),
+                'lines_s': st['lines'] / seconds if seconds else 0.0,
+                'bytes_s': st['bytes'] / seconds if seconds else 0.0,
+                'rtt_s': st['rtt_s'] / st['lines'] if st['lines'] else 0.0}
+
+class ControllerEmulator:
+    # Stand-in controller for trying senders without a machine. A received line is
+    # parsed into a planner of `planner` moves once there is room, and answered
+    # with `ok` `latency` seconds later; moves take move_time seconds each and
+    # M400 waits for the planner to drain. Unparsed bytes beyond rx_buffer count
+    # as an overflow, where a real controller would drop them.
+    MOTION = ('G0', 'G1', 'G2', 'G3')
+
+    def __init__(self, rx_buffer=128, planner=16, move_time=0.0, latency=0.0, advanced_ok=False):
+        self.rx_buffer, self.planner, self.move_time = rx_buffer, planner, move_time
+        self.latency, self.advanced_ok = latency, advanced_ok
+        self.stats = {'lines': 0, 'bytes': 0, 'overflows': 0, 'max_rx': 0}
+
+    def run(self, link):
+        # Serves one connection until the sender closes it.
+        buf, busy, replies = b'', deque(), deque()  # busy: planned moves' end times
+        while True:
+            now = time.perf_counter()
+            while busy and busy[0] <= now: busy.popleft()
+            while b"\n" in buf and len(busy) < self.planner:
+                line, _, rest = buf.partition(b"\n")
+                cmd = line.split(b';')[0].strip().decode(errors='replace')
+                if cmd.startswith('M400') and busy: break
+                buf = rest
+                self.stats['lines'] += 1
+                self.stats['bytes'] += len(line) + 1
+                if cmd.split()[:1] and cmd.split()[0] in self.MOTION and self.move_time:
+                    busy.append(max(busy[-1] if busy else now, now) + self.move_time)
+                free = self.planner - len(busy)
+                queued = buf.count(b"\n")
+                ok = f"ok P{free} B{max(0, free - queued)}" if self.advanced_ok else "ok"
+                replies.append((now + self.latency, (ok + "\n").encode()))
+            due = b"".join(r for t, r in replies if t <= now)
+            while replies and replies[0][0] <= now: replies.popleft()
+            if due: link.write(due)
+            waits = [t - now for t in (replies[0][0] if replies else None,
+                                       busy[0] if busy and b"\n" in buf else None) if t is not None]
+            try:
+                data = link.read(max(0.0, min(waits)) if waits else None)
+            except ConnectionError:
+                return self.stats
+            if len(buf) <= self.rx_buffer < len(buf) + len(data): self.stats['overflows'] += 1
+            buf += data
+            self.stats['max_rx'] = max(self.stats['max_rx'], len(buf))
+
+    def serve_pty(self, ready=print):
+        # Opens a pty, reports its device path and serves it until closed.
+        import pty, tty
+        import select
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        ready(os.ttyname(slave))
+        try:
+            # our end of the slave stays open until the sender has written, or the
+            # master would read EIO before it connects
+            select.select([master], [], [])
+            os.close(slave)
+            return self.run(StreamLink.wrap(master, name='pty'))
+        finally:
+            os.close(master)
+
+    def serve_tcp(self, host='127.0.0.1', port=0, ready=print, once=False):
+        # Listens on host:port (0 = any free port), reports tcp://host:port and
+        # serves connections one after another.
+        import socket
+        srv = socket.create_server((host, port))
+        ready(f"tcp://{host}:{srv.getsockname()[1]}")
+        try:
+            while True:
+                conn, _ = srv.accept()
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with conn:
+                    self.run(StreamLink.wrap(conn.fileno(), conn, 'tcp'))
+                if once: return self.stats
+        finally:
+            srv.close()
+
+def send_main(argv, log=print):
+    ap = argparse.ArgumentParser(prog='send', description='Stream a program to the controller with character-counting flow control.')
+    ap.add_argument('program', help='a .gcode file, or a job spec or image planned on the fly')
+    ap.add_argument('--port', required=True, help='serial device or pty path, or tcp://host:port')
+    ap.add_argument('--baud', type=int, default=115200)
+    ap.add_argument('--rx-buffer', type=int, default=128, help="controller receive buffer in bytes")
+    ap.add_argument('--lines', type=int, help='at most this many lines in flight (1 = wait for every ok)')
+    start = ap.add_mutually_exclusive_group()
+    start.add_argument('--from-line', type=int, default=1, help='resume at this line of the program file')
+    start.add_argument('--from-layer', type=int, help='resume at the start of this layer (1-based)')
+    ap.add_argument('--safe-z', type=float, help='Z to travel at when resuming (default: highest Z before the resume point)')
+    ap.add_argument('--timeout', type=float, default=30.0, help='seconds to wait for a reply')
+    ap.add_argument('--ignore-errors', action='store_true', help='keep streaming after an error reply')
+    ap.add_argument('--set', action='append', metavar='KEY=VALUE', help='override a global setting when planning')
+    args = ap.parse_args(argv)
+    def read_program(path):
+        with open(path) as f:
+            for line in f: yield line.rstrip("\n")
+    if args.program.lower().endswith(('.gcode', '.nc')):
+        lines = read_program(args.program)
+    else:
+        spec, base_dir, _ = collect_jobs([args.program])[0]
+        global_cfg, layers = spec_layers(spec, base_dir)
+        lines = program_lines(with_seed({**global_cfg, **parse_overrides(args.set)}), layers)
+    commands = program_commands(lines, args.from_line, args.from_layer, args.safe_z)
+    show = lambda r: print(f"\r  line {r['line']} (layer {r['layer']})  {r['lines_s']:7.0f} lines/s  "
+                           f"{r['bytes_s'] / 1000:6.1f} kB/s  ok after {r['rtt_s'] * 1000:5.1f} ms", end='', flush=True)
+    try:
+        link = StreamLink(args.port, args.baud)
+    except (OSError, ValueError) as e:
+        ap.error(f"{args.port}: {e}")
+    try:
+        sender = GcodeSender(link, args.rx_buffer, args.lines, args.timeout, not args.ignore_errors, show)
+        try:
+            r = sender.stream(commands)
+        except (RuntimeError, TimeoutError, ConnectionError) as e:
+            print()
+            log(f"  STOPPED  {e}")
+            log("  resume with --from-line <the line reported above>")
+            return 1
+    finally:
+        link.close()
+    print()
+    # 10 bits per byte on the wire; ptys and sockets have no baud rate to fill
+    serial = not args.port.startswith(('tcp://', '/dev/pts/'))
+    util = f", {r['bytes_s'] * 10 / args.baud:.0%} of the link" if serial else ''
+    log(f"  {r['lines']} lines, {r['bytes']} bytes in {fmt_duration(r['seconds'])} ({r['seconds']:.2f}s): "
+        f"{r['lines_s']:.0f} lines/s, {r['bytes_s'] / 1000:.1f} kB/s{util}, mean ok {r['rtt_s'] * 1000:.1f} ms")
+    for line, reply in r['errors']: log(f"  line {line}: {reply}")
+    return 0
+
+def emulate_main(argv, log=print):
+    ap = argparse.ArgumentParser(prog='emulate', description='Controller stand-in answering ok, for testing the sender.')
+    where = ap.add_mutually_exclusive_group()
+    where.add_argument('--pty', action='store_true', help='serve a pty (the default)')
+    where.add_argument('--tcp', metavar='[HOST:]PORT', help='listen on a TCP port')
+    ap.add_argument('--rx-buffer', type=int, default=128)
+    ap.add_argument('--planner', type=int, default=16, help='planner slots')
+    ap.add_argument('--move-time', type=float, default=0.0, help='seconds each move takes')
+    ap.add_argument('--latency', type=float, default=0.0, help='seconds from parsing a line to its ok')
+    ap.add_argument('--advanced-ok', action='store_true', help="answer Marlin-style 'ok P.. B..'")
+    args = ap.parse_args(argv)
+    emu = ControllerEmulator(args.rx_buffer, args.planner, args.move_time, args.latency, args.advanced_ok)
+    ready = lambda target: print(f"  emulating a controller on {target}", flush=True)
+    try:
+        if args.tcp:
+            host, _, port = args.tcp.rpartition(':')
+            emu.serve_tcp(host or '127.0.0.1', int(port), ready)
+        else:
+            emu.serve_pty(ready)
+    except KeyboardInterrupt:
+        pass
+    s = emu.stats
+    log(f"  {s['lines']} lines, {s['bytes']} bytes, {s['overflows']} overflow(s), peak {s['max_rx']} B buffered")
+    return 1 if s['overflows'] else 0
+
+
+# ─────────────────────────────────────────────
+# MAIN
+# ─────────────────────────────────────────────
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
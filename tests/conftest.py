@@ -0,0 +1,29 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+from PIL import Image, ImageDraw
+
+# The app is a single script with a hyphenated name; load it once as `painting` so
+# the tests can import it and pool workers can unpickle its functions.
+HERE = os.path.dirname(os.path.abspath(__file__))
+if 'painting' not in sys.modules:
+    spec = importlib.util.spec_from_file_location(
+        'painting', os.path.join(HERE, '..', 'Multi-color-robotic-painting.py'))
+    sys.modules['painting'] = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sys.modules['painting'])
+
+
+@pytest.fixture
+def blobs_png(tmp_path):
+    # a few dark shapes on white, one with a hole, at a size that is not a round number
+    img = Image.new('L', (233, 171), 255)
+    d = ImageDraw.Draw(img)
+    d.ellipse((10, 12, 120, 150), fill=0)
+    d.ellipse((45, 50, 80, 100), fill=255)
+    d.rectangle((140, 20, 220, 60), fill=30)
+    d.polygon([(150, 160), (225, 90), (200, 165)], fill=60)
+    path = str(tmp_path / 'blobs.png')
+    img.save(path)
+    return path
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+import painting
+
+Engine = painting.ConcentricEngine
+
+
+def random_mask(h, w, seed):
+    from scipy import ndimage
+    rng = np.random.default_rng(seed)
+    return ndimage.binary_opening(rng.random((h, w)) < 0.7)
+
+
+def contour_set(contours):
+    # contours as a set, closed ones rotated to start at their smallest point
+    out = set()
+    for ct in contours:
+        pts = [tuple(p) for p in np.round(ct, 6).tolist()]
+        closed = pts[0] == pts[-1]
+        if closed:
+            pts = pts[:-1]
+            k = pts.index(min(pts))
+            pts = pts[k:] + pts[:k]
+        out.add((closed, tuple(pts)))
+    return out
+
+
+def reference_contours(arr, step):
+    # the original loop: trace, erode step times with the default cross, repeat
+    from scipy import ndimage
+    from skimage import measure
+    out = []
+    while arr.any():
+        out += measure.find_contours(arr.astype(np.float32), 0.5)
+        arr = ndimage.binary_erosion(arr, iterations=step)
+    return out
+
+
+@pytest.mark.parametrize('h, w', [(48, 48), (37, 53), (65, 40), (17, 9)])
+@pytest.mark.parametrize('step', [1, 2, 5])
+@pytest.mark.parametrize('tile', [0, 16])
+def test_rings_match_iterated_erosion(h, w, step, tile):
+    arr = random_mask(h, w, h + w + step)
+    if tile:
+        rings = Engine.tiled_contours(painting.BitMask.pack(arr), step, 'taxicab', tile=tile)
+    else:
+        rings = Engine.contours(arr, step, 'taxicab')
+    assert contour_set(rings) == contour_set(reference_contours(arr, step))
+
+
+# canvas sizes around multiples of the tile, down to a 1 px last row or column
+@pytest.mark.parametrize('h, w', [(64, 64), (65, 40), (40, 65), (33, 47), (17, 9)])
+@pytest.mark.parametrize('metric', ['taxicab', 'chessboard'])
+@pytest.mark.parametrize('step', [1, 3])
+def test_tiled_matches_untiled(h, w, metric, step):
+    arr = random_mask(h, w, h * w)
+    ref = contour_set(Engine.contours(arr, step, metric))
+    tiled = contour_set(Engine.tiled_contours(painting.BitMask.pack(arr), step, metric, tile=16))
+    assert tiled == ref
+
+
+def test_progress_within_a_single_region():
+    # one big region: progress (which is where a job checks for cancel) comes per level
+    yy, xx = np.mgrid[0:120, 0:120]
+    arr = (xx - 60) ** 2 + (yy - 60) ** 2 < 55 ** 2
+    fracs = []
+    contours = list(Engine.contours(arr, 2, 'taxicab', fracs.append))
+    assert len(fracs) >= len(contours) > 20
+    assert fracs == sorted(fracs) and 0 <= fracs[0] and fracs[-1] <= 1
+
+    class Cancelled(Exception):
+        pass
+
+    def cancel(frac):
+        if frac > 0.25: raise Cancelled()
+    traced = []
+    with pytest.raises(Cancelled):
+        for ct in Engine.contours(arr, 2, 'taxicab', cancel):
+            traced.append(ct)
+    assert 0 < len(traced) < len(contours) / 2
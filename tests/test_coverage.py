@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+import painting
+
+
+def rows(n=12, step=2.0, x0=5.0, x1=95.0):
+    # boustrophedon rows, as the lines infill would leave them
+    out = []
+    for k in range(n):
+        y = 5.0 + k * step
+        out.append(np.array([(x0, y), (x1, y)] if k % 2 == 0 else [(x1, y), (x0, y)]))
+    return out
+
+
+def overpaint(paths, brush_w=4.0):
+    target = np.ones((40, 100), bool)
+    return painting.CoverageAnalyzer(target, 1.0, (0, 0), brush_w).analyze(paths)['overpaint']
+
+
+def test_single_stroke_is_one_pass():
+    assert overpaint(painting.PathSet.from_arrays(rows(1))) == 1.0
+
+
+@pytest.mark.parametrize('step', [1.0, 2.0, 3.0])
+def test_zigzag_rows_count_like_lines(step):
+    # the same rows as separate strokes or linked into one zig-zag paint the same passes,
+    # but for the turns, which a zig-zag paints in one go
+    lines = painting.PathSet.from_arrays(rows(step=step))
+    zigzag = painting.PathSet.from_arrays([np.concatenate(rows(step=step))])
+    assert overpaint(lines) > 1.2
+    assert overpaint(zigzag) == pytest.approx(overpaint(lines), rel=0.03)
+
+
+def test_planned_lines_and_zigzag_agree(blobs_png):
+    report = {}
+    for infill in ('lines', 'zigzag'):
+        cfg = {**painting.DEFAULT_CFG, 'dip_x': 66, 'dip_y': 862, 'infill_type': infill, 'infill_angle': 30,
+               'target_width': 120, 'cache': False}
+        report[infill] = painting.analyze_layer(cfg, blobs_png)
+    assert report['zigzag']['overpaint'] == pytest.approx(report['lines']['overpaint'], rel=0.03)
+    assert report['zigzag']['coverage_pct'] == pytest.approx(report['lines']['coverage_pct'], abs=0.5)
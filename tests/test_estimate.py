@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+import painting
+
+
+def dip_then_stroke(dip_z, length=100.0):
+    # one dip cycle, then a single straight stroke of `length` mm at z_paint
+    cfg = {**painting.DEFAULT_CFG, 'dip_x': 66, 'dip_y': 862, 'dip_z': dip_z, 'seed': 1}
+    p = painting.UltraPainter(cfg)
+    x, y = 300.0, 500.0
+    p._perform_dip_and_travel(x, y)
+    p._set_speed('paint')
+    p.gcode.move('G1', z=cfg['z_paint'], f=2500)
+    p.gcode.move('G1', x + length, y)
+    p.gcode.move('G0', z=cfg['z_low'], f=3000)
+    return cfg, p.gcode.drain()
+
+
+@pytest.mark.parametrize('dip_z', [0.0, -5.0])
+def test_dip_spiral_is_not_paint(dip_z):
+    cfg, lines = dip_then_stroke(dip_z)
+    report = painting.estimate_gcode(lines, cfg)
+    assert report['dips'] == 1
+    assert report['paint_mm'] == pytest.approx(100.0)
+    assert report['travel_mm'] == 0.0
+    assert report['z_lifts'] == 1
+    assert report['dip_s'] > 0
+
+
+def test_dip_phase_does_not_depend_on_dip_z():
+    # dipping at z_paint only changes the plunge depth into the dish
+    at_paint = painting.estimate_gcode(dip_then_stroke(0.0)[1], painting.DEFAULT_CFG)
+    below = painting.estimate_gcode(dip_then_stroke(-5.0)[1], painting.DEFAULT_CFG)
+    for key in ('paint_s', 'travel_s', 'z_s', 'paint_mm', 'travel_mm', 'z_lifts'):
+        assert at_paint[key] == pytest.approx(below[key])
+
+
+@pytest.mark.parametrize('min_dist, max_dist', [(240, 280), (10, 14), (0, 0)])
+def test_split_strokes_paint_their_full_length(min_dist, max_dist):
+    # a stroke longer than the load is split with a dip at each split; the paint
+    # between dips adds up to the stroke, and everything else is dip or Z
+    cfg = {**painting.DEFAULT_CFG, 'dip_x': 66, 'dip_y': 862, 'seed': 2,
+           'min_dist': min_dist, 'max_dist': max_dist}
+    p = painting.UltraPainter(cfg)
+    t = np.linspace(0, 40 * np.pi, 2001)
+    pts = np.column_stack((300 + 10 * t, 500 + 5 * np.sin(t)))
+    length = float(np.hypot(*np.diff(pts, axis=0).T).sum())
+    p._perform_dip_and_travel(*pts[0].tolist())
+    p._set_speed('paint')
+    p.gcode.move('G1', z=cfg['z_paint'], f=2500)
+    p._paint(pts)
+    p.gcode.move('G0', z=cfg['z_low'], f=3000)
+    report = painting.estimate_gcode(p.gcode.drain(), cfg)
+    splits = p.stats['splits']
+    if max_dist:
+        assert length / max_dist - 1 <= splits <= length / min_dist
+    else:
+        assert splits == 0
+    assert report['dips'] == splits + 1
+    assert report['z_lifts'] == splits + 1
+    assert report['paint_mm'] == pytest.approx(length, abs=0.1)  # coordinates go out to 3 decimals
+    assert report['travel_mm'] == 0.0
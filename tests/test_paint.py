@@ -0,0 +1,48 @@
+import pytest
+
+import painting
+
+
+def layer(**cfg):
+    return {**painting.DEFAULT_CFG, 'dip_x': 66, 'dip_y': 862, 'infill_type': 'lines', 'infill_angle': 0,
+            'target_width': 120, 'seed': 3, 'cache': False, **cfg}
+
+
+@pytest.mark.parametrize('schedule', ['travel', 'dips'])
+@pytest.mark.parametrize('arc_tol', [0, 0.05])
+def test_zero_dip_budget_paints_without_splitting(blobs_png, schedule, arc_tol):
+    # a blank Min/Max Dist field in the UI sends 0; splitting at a zero budget never advanced
+    cfg = layer(min_dist=0, max_dist=0, schedule=schedule, arc_tol=arc_tol, infill_type='concentric')
+    painter = painting.UltraPainter(cfg)
+    lines = list(painter.generate(blobs_png, header=False))
+    assert painter.stats['splits'] == 0
+    assert painter.stats['dips'] <= painter.stats['paths']
+    assert len(lines) < 20 * painter.stats['points']
+
+
+@pytest.mark.parametrize('value', [0, -5, None, ''])
+def test_dip_distances_must_be_positive(blobs_png, value):
+    layers = [{'image_path': blobs_png, 'enabled': True}]
+    for key in ('min_dist', 'max_dist'):
+        _, error = painting.active_layers({'global': {**painting.DEFAULT_CFG, key: value}, 'layers': layers})
+        assert error is not None
+    assert painting.active_layers({'global': painting.DEFAULT_CFG, 'layers': layers})[1] is None
+    assert painting.active_layers({'layers': layers})[1] is None
+
+
+@pytest.mark.parametrize('cfg', [
+    {},
+    {'min_dist': 10, 'max_dist': 14},  # a split inside nearly every batch
+    {'infill_type': 'zigzag', 'infill_angle': 30, 'schedule': 'dips', 'accel_sync': True},
+    {'infill_type': 'concentric', 'min_dist': 20, 'max_dist': 25},
+])
+def test_batched_emission_matches_point_by_point(blobs_png, monkeypatch, cfg):
+    # the batched paint loop and its vectorised formatting write the same bytes as
+    # painting every point through the per-point loop
+    def program():
+        # unsimplified, so paths are long enough to go in batches
+        return "\n".join(painting.UltraPainter(layer(simplify_tol=0, **cfg)).generate(blobs_png, header=False))
+    batched = program()
+    monkeypatch.setattr(painting.UltraPainter, 'PAINT_BATCH', 1 << 30)
+    assert program() == batched
+    assert batched.count("\nG1 X") > 500
@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+import painting
+
+
+@pytest.mark.parametrize('infill, angle', [('lines', 0), ('lines', 33), ('zigzag', 0), ('zigzag', -20),
+                                           ('concentric', 0)])
+def test_infill_workers_match_serial(blobs_png, infill, angle):
+    traced = []
+    for workers in (1, 3):
+        cfg = {**painting.DEFAULT_CFG, 'dip_x': 66, 'dip_y': 862, 'infill_type': infill, 'infill_angle': angle,
+               'target_width': 120, 'cache': False, 'infill_workers': workers}
+        painter = painting.UltraPainter(cfg)
+        paths = painter.trace_paths(painter.load_mask(blobs_png))
+        traced.append((paths, painter.regions))
+    (serial, serial_regions), (pooled, pooled_regions) = traced
+    assert len(serial) > 10
+    assert np.array_equal(pooled.offsets, serial.offsets)
+    assert np.array_equal(pooled.xy, serial.xy)
+    if infill == 'zigzag':
+        assert np.array_equal(pooled_regions, serial_regions)
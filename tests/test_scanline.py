@@ -0,0 +1,54 @@
+import math
+
+import numpy as np
+import pytest
+
+import painting
+
+
+def reference_runs(arr, angle, step_px):
+    # the original per-pixel scanline loop, in pixel coordinates
+    angle_rad = math.radians(angle)
+    cos_a, sin_a = math.cos(angle_rad), math.sin(angle_rad)
+    h, w = arr.shape
+    cx, cy = w / 2.0, h / 2.0
+    diag = int(math.hypot(w, h)) + 10
+    runs = []
+    for y_rot in range(-diag, diag, max(1, step_px)):
+        line = []
+        for x_rot in range(-diag, diag):
+            orig_x = int(cx + x_rot * cos_a - y_rot * sin_a)
+            orig_y = int(cy + x_rot * sin_a + y_rot * cos_a)
+            if 0 <= orig_x < w and 0 <= orig_y < h and arr[orig_y, orig_x]:
+                line.append((orig_x, orig_y))
+            else:
+                if len(line) > 1: runs.append(line)
+                line = []
+        if len(line) > 1: runs.append(line)
+    return runs
+
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('angle', [0, 17.3, 45, 90, 133.7, -61])
+@pytest.mark.parametrize('step_px', [1, 3])
+def test_spans_match_the_per_pixel_loop(monkeypatch, seed, angle, step_px):
+    rng = np.random.default_rng(seed)
+    h, w = rng.integers(5, 40, 2)
+    arr = rng.random((h, w)) < rng.uniform(0.3, 0.9)
+    monkeypatch.setattr(painting.ScanlineEngine, 'BATCH', 257)  # several bands of scanlines
+    runs = [list(zip(xs.tolist(), ys.tolist()))
+            for _, _, _, xs, ys in painting.ScanlineEngine.spans(arr, angle, step_px)]
+    assert runs == reference_runs(arr, angle, step_px)
+
+
+@pytest.mark.parametrize('angle', [0, 33, 90])
+def test_lines_infill_paths(angle):
+    rng = np.random.default_rng(7)
+    arr = rng.random((31, 47)) < 0.7
+    cfg = {**painting.DEFAULT_CFG, 'dip_x': 66, 'dip_y': 862, 'infill_type': 'lines', 'infill_angle': angle}
+    painter = painting.UltraPainter(cfg)
+    paths = painter.trace_paths(painting.BitMask.pack(arr))
+    step_px = int(cfg['brush_w'] * (1 - cfg['overlap']) * painter.res)
+    ref = [np.array(run) / painter.res + (cfg['x_off'], cfg['y_off']) for run in reference_runs(arr, angle, step_px)]
+    assert len(paths) == len(ref)
+    assert np.array_equal(paths.xy, np.concatenate(ref))